@@ -1,18 +1,42 @@
-from telegram import Update
+from telegram import Bot, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter, TelegramError
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
     Application,
     MessageHandler,
     filters,
     ContextTypes,
     CallbackContext,
-    CommandHandler
+    CallbackQueryHandler,
+    CommandHandler,
+    ChatMemberHandler,
+    TypeHandler
 )
+import asyncio
+import bisect
 import datetime
+import functools
+import hashlib
+import hmac
+import inspect
 import json
+import logging
 import os
 import pytz
 import re
+import secrets
+import shutil
+import signal
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque, namedtuple
 from pathlib import Path
+from sortedcontainers import SortedList
 
 # === Config ===
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", os.getenv("TELEGRAM_TOKEN", "YOUR_BOT_TOKEN"))
@@ -24,114 +48,2490 @@ SUBTRACT_KEYWORDS = ['حذف']
 # Railway port configuration
 PORT = int(os.getenv("PORT", 8000))
 
+# Update delivery: "polling" (default) or "webhook". In webhook mode Telegram
+# POSTs updates to WEBHOOK_PATH on PORT; WEBHOOK_URL is the public base URL to
+# register, and WEBHOOK_SECRET is checked against every request's secret token.
+# Webhook mode won't run without one: it's generated if WEBHOOK_URL is set
+# (the webhook is registered with it), and required otherwise
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Write-behind points store: flush dirty groups every N seconds, or sooner
+# once this many changes are pending
+POINTS_FLUSH_INTERVAL = float(os.getenv("POINTS_FLUSH_INTERVAL", 5))
+POINTS_FLUSH_MAX_PENDING = int(os.getenv("POINTS_FLUSH_MAX_PENDING", 200))
+# Resident per-group state (points, learned usernames, admin lists) is kept
+# within roughly this many bytes by evicting the least recently used groups,
+# and groups untouched for N seconds are evicted regardless; both only once
+# their changes are on disk
+POINTS_MEMORY_BUDGET = int(os.getenv("POINTS_MEMORY_BUDGET", 64 * 1024 * 1024))
+POINTS_IDLE_EVICT = float(os.getenv("POINTS_IDLE_EVICT", 30 * 60))
+
+# Every point change is appended to a journal first: buffered lines are
+# fsynced every N seconds, and the journal is folded into the snapshots once
+# it grows past this many bytes. /undo can reach back this many actions
+JOURNAL_DIR = Path(os.getenv("JOURNAL_DIR", Path(DATA_DIR) / 'journal'))
+JOURNAL_SYNC_INTERVAL = float(os.getenv("JOURNAL_SYNC_INTERVAL", 0.2))
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", 4 * 1024 * 1024))
+UNDO_HISTORY = int(os.getenv("UNDO_HISTORY", 20))
+
+# Sharded mode: with SHARDS > 1 this process becomes a dispatcher that
+# receives updates (polling or webhook) and forwards each one over a unix
+# socket to the worker process owning its chat on a consistent-hash ring.
+# Workers are started by the dispatcher with SHARD_INDEX set
+SHARDS = max(1, int(os.getenv("SHARDS", 1)))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", -1))
+SHARD_DIR = Path(os.getenv("SHARD_DIR", Path(DATA_DIR) / 'shards'))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", 64))
+# At startup the dispatcher tries each shard's socket this many times,
+# backing off up to a few seconds. Later, updates for a shard that is down
+# (e.g. restarting) wait in its queue of up to SHARD_QUEUE_SIZE until it is
+# back; once that is full, polling holds its offset and the webhook answers
+# 503, so Telegram delivers them again later
+SHARD_CONNECT_RETRIES = int(os.getenv("SHARD_CONNECT_RETRIES", 8))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", 1000))
+SHARD_MAX_UPDATE_BYTES = 4 * 1024 * 1024
+# Each shard keeps its own journal
+SHARD_JOURNAL_DIR = JOURNAL_DIR / f'shard-{SHARD_INDEX}' if SHARD_INDEX >= 0 else JOURNAL_DIR
+
+# Storage backend: "json" (one file per group) or "sqlite" (single WAL database)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", Path(DATA_DIR) / 'mechabdol.db'))
+
+# How many updates PTB may process at once (0 = one at a time). Point changes
+# stay ordered per group regardless; idle group workers exit after N seconds
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 64))
+GROUP_WORKER_IDLE_TIMEOUT = float(os.getenv("GROUP_WORKER_IDLE_TIMEOUT", 60))
+
+# Member display names are cached for leaderboards (entries, seconds)
+NAME_CACHE_SIZE = int(os.getenv("NAME_CACHE_SIZE", 50000))
+NAME_CACHE_TTL = float(os.getenv("NAME_CACHE_TTL", 6 * 60 * 60))
+
+# Bot API limits: requests per second for the whole bot, member lookups per
+# second in one chat, and how many lookups may be in flight at once. Messages
+# sent to a chat are paced by the OUTBOX_CHAT_* per-minute limit instead.
+# With SHARDS > 1 each worker gets 1/SHARDS of the bot-wide rate, since they
+# all share one token
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", 30))
+API_CHAT_RATE_LIMIT = float(os.getenv("API_CHAT_RATE_LIMIT", 20))
+LOOKUP_CONCURRENCY = int(os.getenv("LOOKUP_CONCURRENCY", 10))
+
+# Outgoing messages per group (queued replies, weekly boards and /dash page
+# edits alike): messages per minute and how many may go out back to back
+# before throttling kicks in
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 20))
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", 3))
+
+# The group registry records last activity to within this many seconds and
+# is written back this often
+GROUP_ACTIVITY_RESOLUTION = float(os.getenv("GROUP_ACTIVITY_RESOLUTION", 60 * 60))
+REGISTRY_FLUSH_INTERVAL = float(os.getenv("REGISTRY_FLUSH_INTERVAL", 60))
+
+# After downtime, polling first replays the pending backlog with this many
+# chats at a time. Point changes from messages sent before the bot started
+# are acknowledged with one summary per group once its backlog has been quiet
+# for N seconds. The last REPLAY_WINDOW updates that changed each group's
+# points are remembered, so a redelivered update is skipped
+CATCH_UP_CONCURRENCY = int(os.getenv("CATCH_UP_CONCURRENCY", 32))
+CATCH_UP_SUMMARY_DELAY = float(os.getenv("CATCH_UP_SUMMARY_DELAY", 5))
+REPLAY_WINDOW = int(os.getenv("REPLAY_WINDOW", 200))
+
+# Admin list syncs for a group are coalesced within this many seconds
+ADMIN_SYNC_DEBOUNCE = float(os.getenv("ADMIN_SYNC_DEBOUNCE", 10))
+
+# Leaderboards show this many of the top members; /rank shows this many
+# neighbours on each side of the user
+LEADERBOARD_TOP_N = int(os.getenv("LEADERBOARD_TOP_N", 50))
+RANK_NEIGHBOURS = int(os.getenv("RANK_NEIGHBOURS", 2))
+
+# /dash pages through the leaderboard this many members at a time; rendered
+# pages are cached for this many groups
+LEADERBOARD_PAGE_SIZE = int(os.getenv("LEADERBOARD_PAGE_SIZE", 25))
+LEADERBOARD_CACHE_GROUPS = int(os.getenv("LEADERBOARD_CACHE_GROUPS", 1000))
+
+# /history shows this many past weeks by default (at most HISTORY_MAX_WEEKS),
+# with each week's top HISTORY_TOP_N members
+HISTORY_WEEKS_SHOWN = int(os.getenv("HISTORY_WEEKS_SHOWN", 4))
+HISTORY_MAX_WEEKS = int(os.getenv("HISTORY_MAX_WEEKS", 26))
+HISTORY_TOP_N = int(os.getenv("HISTORY_TOP_N", 3))
+
+# Test-score replies list at most this many lines that couldn't be parsed
+MAX_REPORTED_MALFORMED_LINES = 10
+
+# The weekly leaderboard sweep spreads its sends over this many seconds, with
+# at most this many groups in flight (split across shards), and checkpoints
+# progress this often
+LEADERBOARD_SWEEP_WINDOW = float(os.getenv("LEADERBOARD_SWEEP_WINDOW", 15 * 60))
+LEADERBOARD_SWEEP_CONCURRENCY = int(os.getenv("LEADERBOARD_SWEEP_CONCURRENCY", 8))
+SWEEP_CHECKPOINT_INTERVAL = float(os.getenv("SWEEP_CHECKPOINT_INTERVAL", 2))
+
+# Groups whose weekly send failed are retried this many times, waiting this
+# many seconds and doubling each round; anything still failing leaves the
+# sweep unfinished and it resumes after one more doubling
+LEADERBOARD_SWEEP_RETRIES = int(os.getenv("LEADERBOARD_SWEEP_RETRIES", 3))
+LEADERBOARD_SWEEP_RETRY_DELAY = float(os.getenv("LEADERBOARD_SWEEP_RETRY_DELAY", 60))
+
+# Logs go to stdout as "text" lines, or as one JSON object per line with
+# LOG_FORMAT=json for log shipping
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# /metrics histogram buckets in seconds: handlers and API calls, then job lag
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 30, 60, 300, 900)
+EVENT_LOOP_PROBE_INTERVAL = float(os.getenv("EVENT_LOOP_PROBE_INTERVAL", 1))
+
+# === Logging ===
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message and any extra fields."""
+
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.datetime.fromtimestamp(record.created, pytz.UTC).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.RESERVED)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def tag_shard(record: logging.LogRecord) -> bool:
+    record.shard = SHARD_INDEX
+    return True
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    elif SHARD_INDEX >= 0:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [shard %(shard)s] %(message)s'))
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    if SHARD_INDEX >= 0:
+        # Shard workers share the dispatcher's stdout, so tag their records
+        handler.addFilter(tag_shard)
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler], force=True)
+    # httpx logs every Bot API request and APScheduler every job run at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
+
+configure_logging()
+log = logging.getLogger('mechabdol')
+
+# === Metrics ===
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines.extend(f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values)
+        return lines
+
+class HistogramMetric:
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+class GaugeMetric:
+    """Read at scrape time from a callback, so nothing is tracked in between."""
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+class MetricsRegistry:
+    """
+    Minimal Prometheus text-format metrics. Counters and histograms take a
+    lock per update, so they can be touched from storage worker threads too.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> CounterMetric:
+        metric = CounterMetric(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> HistogramMetric:
+        metric = HistogramMetric(name, help_text, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, read) -> GaugeMetric:
+        metric = GaugeMetric(name, help_text, read)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                log.warning(f"⚠️ Could not render metric {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram(
+    'mechabdol_handler_duration_seconds', 'Time spent in update handlers and jobs.', ('handler',)
+)
+handler_errors = metrics.counter(
+    'mechabdol_handler_errors_total', 'Handler and job calls that raised.', ('handler',)
+)
+api_seconds = metrics.histogram(
+    'mechabdol_bot_api_request_duration_seconds', 'Bot API request latency.', ('method',)
+)
+api_requests = metrics.counter(
+    'mechabdol_bot_api_requests_total', 'Bot API requests by HTTP status ("error" if no response).', ('method', 'status')
+)
+api_retry_after = metrics.counter(
+    'mechabdol_bot_api_retry_after_total', 'Bot API requests answered with 429 RetryAfter.', ('method',)
+)
+storage_operations = metrics.counter(
+    'mechabdol_storage_operations_total', 'Storage backend calls.', ('backend', 'operation')
+)
+storage_seconds = metrics.histogram(
+    'mechabdol_storage_operation_duration_seconds', 'Storage backend call latency.', ('backend', 'kind')
+)
+storage_bytes = metrics.counter(
+    'mechabdol_storage_bytes_total', 'Bytes read from and written to data files (JSON files, journal).', ('direction',)
+)
+job_lag_seconds = metrics.histogram(
+    'mechabdol_job_lag_seconds', 'How late scheduled jobs were submitted.', ('job',), LAG_BUCKETS
+)
+event_loop_lag_seconds = metrics.histogram(
+    'mechabdol_event_loop_lag_seconds', 'How late a periodic probe wakes up on the event loop.', (), LAG_BUCKETS
+)
+process_started = time.time()
+metrics.gauge('mechabdol_process_start_time_seconds', 'Unix time the process started.', lambda: process_started)
+
+def instrumented(func):
+    """Record an async handler's duration and failures under its function name."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, name)
+    return wrapper
+
+class InstrumentedRequest(BaseRequest):
+    """Wraps the Bot API transport to time each call and count responses by method."""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            status, payload = await self.inner.do_request(
+                url=url, method=method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        except Exception:
+            api_requests.inc(api_method, 'error')
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - start, api_method)
+        api_requests.inc(api_method, str(status))
+        if status == 429:
+            api_retry_after.inc(api_method)
+        return status, payload
+
+class EventLoopLagProbe:
+    """Sleeps for a fixed interval and records how late it wakes up."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            event_loop_lag_seconds.observe(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+event_loop_probe = EventLoopLagProbe(EVENT_LOOP_PROBE_INTERVAL)
+
 # Create groups data directory if it doesn't exist
 GROUPS_DATA_DIR.mkdir(exist_ok=True)
 
-print(f"📁 Using persistent storage at: {DATA_DIR}")
-print(f"📂 Groups data directory: {GROUPS_DATA_DIR}")
+log.info(f"📁 Using persistent storage at: {DATA_DIR}")
+log.info(f"📂 Groups data directory: {GROUPS_DATA_DIR}")
+
+# === Helper functions for file paths ===
+def get_group_points_file(group_id: int) -> Path:
+    return GROUPS_DATA_DIR / f'points_{group_id}.json'
+
+def get_group_admins_file(group_id: int) -> Path:
+    return GROUPS_DATA_DIR / f'admins_{group_id}.json'
+
+def get_group_owner_file(group_id: int) -> Path:
+    return GROUPS_DATA_DIR / f'owner_{group_id}.txt'
+
+def get_group_usernames_file(group_id: int) -> Path:
+    return GROUPS_DATA_DIR / f'usernames_{group_id}.json'
+
+def get_group_history_file(group_id: int) -> Path:
+    return GROUPS_DATA_DIR / f'history_{group_id}.bin'
+
+def get_group_alltime_file(group_id: int) -> Path:
+    return GROUPS_DATA_DIR / f'alltime_{group_id}.bin'
+
+def get_registry_file(shard_index: int) -> Path:
+    if shard_index < 0:
+        return Path(DATA_DIR) / 'groups_registry.json'
+    return SHARD_DIR / f'groups_registry.shard-{shard_index}.json'
+
+# === Atomic file writes ===
+def atomic_write_text(path: Path, text: str):
+    atomic_write_bytes(path, text.encode())
+
+def atomic_write_bytes(path: Path, data: bytes):
+    # Write to a temp file and rename it over the old one, so a crash
+    # mid-write never leaves a truncated file behind
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    storage_bytes.inc('written', amount=len(data))
+
+def read_file_bytes(path: Path) -> bytes:
+    with open(path, 'rb') as f:
+        data = f.read()
+    storage_bytes.inc('read', amount=len(data))
+    return data
+
+# === Compact standings encoding ===
+def pack_standings(standings: list) -> bytes:
+    """
+    Encode (user_id, points) pairs as a member count followed by two packed
+    little-endian arrays, int64 ids then float64 points: 16 bytes per member.
+    """
+    user_ids = array('q', [user_id for user_id, _ in standings])
+    points = array('d', [pts for _, pts in standings])
+    if sys.byteorder == 'big':
+        user_ids.byteswap()
+        points.byteswap()
+    return struct.pack('<I', len(standings)) + user_ids.tobytes() + points.tobytes()
+
+def unpack_standings(blob: bytes, offset: int = 0):
+    """Decode pack_standings output at offset; returns (standings, end_offset)."""
+    (count,) = struct.unpack_from('<I', blob, offset)
+    offset += 4
+    user_ids = array('q', blob[offset:offset + 8 * count])
+    points = array('d', blob[offset + 8 * count:offset + 16 * count])
+    if sys.byteorder == 'big':
+        user_ids.byteswap()
+        points.byteswap()
+    # Whole scores were stored as floats; hand them back as ints
+    standings = [(user_id, int(pts) if pts.is_integer() else pts) for user_id, pts in zip(user_ids, points)]
+    return standings, offset + 16 * count
+
+def standings_size(blob: bytes, offset: int = 0) -> int:
+    """Byte length of the packed standings at offset, without decoding them."""
+    return 4 + 16 * struct.unpack_from('<I', blob, offset)[0]
+
+def merge_standings(totals: dict, standings: list) -> dict:
+    for user_id, pts in standings:
+        totals[user_id] = totals.get(user_id, 0) + pts
+    return totals
+
+def rank_standings(totals: dict) -> list:
+    return sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+
+# === Load group points ===
+def load_group_snapshot(group_id: int):
+    """
+    Return (points, seq, applied): the group's points, the journal sequence
+    number they include, and the (update_id, message_id) pairs of the latest
+    changes. Older files hold the bare points dict, which counts as seq 0.
+    """
+    points_file = get_group_points_file(group_id)
+    if points_file.exists():
+        try:
+            data = json.loads(read_file_bytes(points_file))
+        except FileNotFoundError:
+            return {}, 0, []
+        except json.JSONDecodeError:
+            # Keep the damaged file for inspection instead of overwriting it
+            # with an empty group on the next flush; the journal replays on top
+            corrupt_file = points_file.with_suffix('.corrupt')
+            os.replace(points_file, corrupt_file)
+            log.warning(
+                f"⚠️ Points file for group {group_id} is corrupt, moved it to {corrupt_file.name}",
+                extra={'group_id': group_id}
+            )
+            return {}, 0, []
+        if isinstance(data.get('points'), dict):
+            return data['points'], data.get('seq', 0), [tuple(pair) for pair in data.get('applied', [])]
+        return data, 0, []
+    return {}, 0, []
+
+# === Save group points ===
+def save_group_points(group_id: int, points: dict, seq: int = 0, applied: list = ()):
+    atomic_write_text(
+        get_group_points_file(group_id),
+        json.dumps({'seq': seq, 'points': points, 'applied': [list(pair) for pair in applied]})
+    )
+
+def pack_applied(applied: list) -> bytes:
+    return array('q', [value for pair in applied for value in pair]).tobytes()
+
+def unpack_applied(blob) -> list:
+    if not blob:
+        return []
+    values = array('q', blob)
+    return list(zip(values[::2], values[1::2]))
+
+# === Storage backends ===
+class JsonStorage:
+    """The original layout: one points/admins/owner file per group in GROUPS_DATA_DIR."""
+
+    name = 'json'
+
+    def load_snapshot(self, group_id: int):
+        return load_group_snapshot(group_id)
+
+    def write_points(self, group_id: int, points: dict, deltas: dict, reset: bool, seq: int = 0, applied: list = ()):
+        # A JSON file can't be patched in place, so always write the full snapshot
+        save_group_points(group_id, points, seq, applied)
+
+    def load_owner(self, group_id: int):
+        owner_file = get_group_owner_file(group_id)
+        if owner_file.exists():
+            try:
+                return int(read_file_bytes(owner_file).decode().strip())
+            except (ValueError, FileNotFoundError):
+                pass
+        return None
+
+    def save_owner(self, group_id: int, owner_id):
+        if owner_id is None:
+            get_group_owner_file(group_id).unlink(missing_ok=True)
+            return
+        atomic_write_text(get_group_owner_file(group_id), str(owner_id))
+
+    def load_admins(self, group_id: int) -> list:
+        admins_file = get_group_admins_file(group_id)
+        if admins_file.exists():
+            try:
+                return json.loads(read_file_bytes(admins_file))
+            except (json.JSONDecodeError, FileNotFoundError):
+                pass
+        return []
+
+    def save_admins(self, group_id: int, admin_ids: list):
+        atomic_write_text(get_group_admins_file(group_id), json.dumps(admin_ids))
+
+    def load_usernames(self, group_id: int) -> dict:
+        usernames_file = get_group_usernames_file(group_id)
+        if usernames_file.exists():
+            try:
+                return json.loads(read_file_bytes(usernames_file))
+            except (json.JSONDecodeError, FileNotFoundError):
+                log.warning(f"⚠️ Could not load usernames file for group {group_id}", extra={'group_id': group_id})
+        return {}
+
+    def save_usernames(self, group_id: int, usernames: dict):
+        atomic_write_text(get_group_usernames_file(group_id), json.dumps(usernames))
+
+    def _read_history(self, group_id: int) -> list:
+        # Records are: week length byte, week id, packed standings
+        try:
+            data = read_file_bytes(get_group_history_file(group_id))
+        except FileNotFoundError:
+            return []
+        records = []
+        offset = 0
+        while offset < len(data):
+            try:
+                week_len = data[offset]
+                week = data[offset + 1:offset + 1 + week_len].decode()
+                start = offset + 1 + week_len
+                end = start + standings_size(data, start)
+            except (IndexError, struct.error, UnicodeDecodeError):
+                end = len(data) + 1
+            if end > len(data):
+                # A crash mid-append leaves a torn last record
+                log.warning(
+                    f"⚠️ Ignoring damaged tail of the history file for group {group_id}",
+                    extra={'group_id': group_id}
+                )
+                break
+            records.append((week, data, start))
+            offset = end
+        return records
+
+    def _load_alltime(self, group_id: int):
+        try:
+            data = read_file_bytes(get_group_alltime_file(group_id))
+        except FileNotFoundError:
+            return None, {}
+        week_len = data[0]
+        standings, _ = unpack_standings(data, 1 + week_len)
+        return data[1:1 + week_len].decode(), dict(standings)
+
+    def archive_week(self, group_id: int, week: str, standings: list):
+        """Append a week's final standings and fold them into the all-time totals, once per week."""
+        header = bytes([len(week)]) + week.encode()
+        if week not in {archived for archived, _, _ in self._read_history(group_id)}:
+            record = header + pack_standings(standings)
+            with open(get_group_history_file(group_id), 'ab') as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            storage_bytes.inc('written', amount=len(record))
+        # The aggregate remembers the last week it includes, so a retry after
+        # a crash between the two writes doesn't count the week twice
+        last_week, totals = self._load_alltime(group_id)
+        if last_week is not None and last_week >= week:
+            return
+        merged = rank_standings(merge_standings(totals, standings))
+        atomic_write_bytes(get_group_alltime_file(group_id), header + pack_standings(merged))
+
+    def load_history(self, group_id: int, limit: int = None) -> list:
+        """Return [(week, standings)] newest first, the latest limit weeks."""
+        records = {}
+        for week, data, start in self._read_history(group_id):
+            records[week] = (data, start)
+        weeks = sorted(records, reverse=True)[:limit]
+        return [(week, unpack_standings(*records[week])[0]) for week in weeks]
+
+    def load_alltime(self, group_id: int) -> dict:
+        return self._load_alltime(group_id)[1]
+
+    def load_registry(self):
+        """Return {group_id: (last_active, weekly)} from the manifest, or None if there is none yet."""
+        try:
+            data = json.loads(read_file_bytes(get_registry_file(SHARD_INDEX)))
+            return {
+                int(group_id): (last_active, bool(weekly))
+                for group_id, (last_active, weekly) in data['groups'].items()
+            }
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            log.warning("⚠️ Group registry is damaged; rebuilding it from the stored groups")
+            return None
+
+    def save_registry(self, entries: dict, changed: set):
+        # One file for every group, so it is always rewritten whole
+        groups = {str(group_id): [last_active, int(weekly)] for group_id, (last_active, weekly) in entries.items()}
+        atomic_write_text(get_registry_file(SHARD_INDEX), json.dumps({'groups': groups}, separators=(',', ':')))
+
+    def list_groups(self) -> set:
+        group_ids = set()
+        if not GROUPS_DATA_DIR.exists():
+            return group_ids
+        # Every group has at least one of these once the bot has seen it
+        for file in GROUPS_DATA_DIR.iterdir():
+            prefix, _, rest = file.name.partition('_')
+            if prefix in ('points', 'admins', 'owner', 'history') and rest.endswith(('.json', '.txt', '.bin')):
+                try:
+                    group_ids.add(int(rest.rsplit('.', 1)[0]))
+                except ValueError:
+                    continue
+        return group_ids
+
+    def close(self):
+        pass
+
+class SqliteStorage:
+    """
+    All groups in one SQLite database in WAL mode, with points, admins and
+    owners keyed by (group_id, user_id).
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS groups (
+            group_id INTEGER PRIMARY KEY,
+            points_seq INTEGER NOT NULL DEFAULT 0,
+            last_active INTEGER NOT NULL DEFAULT 0,
+            weekly INTEGER NOT NULL DEFAULT 1,
+            applied BLOB
+        );
+        CREATE TABLE IF NOT EXISTS points (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            points NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS admins (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (group_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS owners (
+            group_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS usernames (
+            group_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (group_id, username)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS history (
+            group_id INTEGER NOT NULL,
+            week TEXT NOT NULL,
+            standings BLOB NOT NULL,
+            PRIMARY KEY (group_id, week)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS alltime (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            points NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (group_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    UPSERT_SQL = (
+        "INSERT INTO points (group_id, user_id, points) VALUES (?, ?, ?) "
+        "ON CONFLICT (group_id, user_id) DO UPDATE SET points = excluded.points"
+    )
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Writes happen from the flush thread and reads from the event loop,
+        # so share one connection behind a lock
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+            # Older databases lack the journal seq and registry columns
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(groups)")}
+            if 'points_seq' not in columns:
+                self._conn.execute("ALTER TABLE groups ADD COLUMN points_seq INTEGER NOT NULL DEFAULT 0")
+            if 'last_active' not in columns:
+                self._conn.execute("ALTER TABLE groups ADD COLUMN last_active INTEGER NOT NULL DEFAULT 0")
+                self._conn.execute("ALTER TABLE groups ADD COLUMN weekly INTEGER NOT NULL DEFAULT 1")
+            if 'applied' not in columns:
+                self._conn.execute("ALTER TABLE groups ADD COLUMN applied BLOB")
+
+    def _register_group(self, group_id: int):
+        self._conn.execute("INSERT OR IGNORE INTO groups (group_id) VALUES (?)", (group_id,))
+
+    def load_snapshot(self, group_id: int):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, points FROM points WHERE group_id = ?", (group_id,)
+            ).fetchall()
+            row = self._conn.execute(
+                "SELECT points_seq, applied FROM groups WHERE group_id = ?", (group_id,)
+            ).fetchone()
+        points = {str(user_id): points for user_id, points in rows}
+        return points, (row[0] if row else 0), unpack_applied(row[1] if row else None)
+
+    def write_points(self, group_id: int, points: dict, deltas: dict, reset: bool, seq: int = 0, applied: list = ()):
+        # Only the changed users are touched, each set to its total from the
+        # snapshot so a retried flush can't count a delta twice; the journal
+        # seq and latest update ids are stored in the same transaction
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._register_group(group_id)
+            if reset:
+                self._conn.execute("DELETE FROM points WHERE group_id = ?", (group_id,))
+            self._conn.executemany(
+                self.UPSERT_SQL,
+                [(group_id, int(user_id), points[user_id]) for user_id in deltas if user_id in points]
+            )
+            self._conn.execute(
+                "UPDATE groups SET points_seq = ?, applied = ? WHERE group_id = ?",
+                (seq, pack_applied(applied), group_id)
+            )
+
+    def load_owner(self, group_id: int):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_id FROM owners WHERE group_id = ?", (group_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_owner(self, group_id: int, owner_id):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._register_group(group_id)
+            if owner_id is None:
+                self._conn.execute("DELETE FROM owners WHERE group_id = ?", (group_id,))
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO owners (group_id, user_id) VALUES (?, ?)", (group_id, owner_id)
+            )
+
+    def load_admins(self, group_id: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id FROM admins WHERE group_id = ?", (group_id,)
+            ).fetchall()
+        return [user_id for (user_id,) in rows]
+
+    def save_admins(self, group_id: int, admin_ids: list):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._register_group(group_id)
+            self._conn.execute("DELETE FROM admins WHERE group_id = ?", (group_id,))
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO admins (group_id, user_id) VALUES (?, ?)",
+                [(group_id, user_id) for user_id in admin_ids]
+            )
+
+    def load_usernames(self, group_id: int) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT username, user_id FROM usernames WHERE group_id = ?", (group_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def save_usernames(self, group_id: int, usernames: dict):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM usernames WHERE group_id = ?", (group_id,))
+            self._conn.executemany(
+                "INSERT INTO usernames (group_id, username, user_id) VALUES (?, ?, ?)",
+                [(group_id, username, user_id) for username, user_id in usernames.items()]
+            )
+
+    def archive_week(self, group_id: int, week: str, standings: list):
+        # The history row and the all-time increments commit together, and a
+        # week that is already archived is left alone
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._register_group(group_id)
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO history (group_id, week, standings) VALUES (?, ?, ?)",
+                (group_id, week, pack_standings(standings))
+            )
+            if cursor.rowcount:
+                self._conn.executemany(
+                    "INSERT INTO alltime (group_id, user_id, points) VALUES (?, ?, ?) "
+                    "ON CONFLICT (group_id, user_id) DO UPDATE SET points = points + excluded.points",
+                    [(group_id, user_id, pts) for user_id, pts in standings]
+                )
+
+    def load_history(self, group_id: int, limit: int = None) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT week, standings FROM history WHERE group_id = ? ORDER BY week DESC LIMIT ?",
+                (group_id, -1 if limit is None else limit)
+            ).fetchall()
+        return [(week, unpack_standings(blob)[0]) for week, blob in rows]
+
+    def load_alltime(self, group_id: int) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, points FROM alltime WHERE group_id = ?", (group_id,)
+            ).fetchall()
+        return dict(rows)
+
+    def load_registry(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT group_id, last_active, weekly FROM groups").fetchall()
+        return {group_id: (last_active, bool(weekly)) for group_id, last_active, weekly in rows}
+
+    def save_registry(self, entries: dict, changed: set):
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT INTO groups (group_id, last_active, weekly) VALUES (?, ?, ?) "
+                "ON CONFLICT (group_id) DO UPDATE SET last_active = excluded.last_active, weekly = excluded.weekly",
+                [(group_id, *entries[group_id]) for group_id in changed if group_id in entries]
+            )
+
+    def list_groups(self) -> set:
+        with self._lock:
+            rows = self._conn.execute("SELECT group_id FROM groups").fetchall()
+        return {group_id for (group_id,) in rows}
+
+    def get_meta(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# === Migrate groups_data/*.json into SQLite ===
+def migrate_json_to_sqlite(target: SqliteStorage, force: bool = False) -> int:
+    """
+    Import every group from the GROUPS_DATA_DIR file layout into SQLite.
+    Runs once per database unless forced; returns the number of groups imported.
+    """
+    if target.get_meta('json_migrated_at') and not force:
+        return 0
+
+    source = JsonStorage()
+    group_ids = source.list_groups()
+
+    for group_id in group_ids:
+        points, seq, applied = source.load_snapshot(group_id)
+        # Reset first so a forced re-run replaces rather than doubles the scores
+        target.write_points(group_id, points, points, reset=True, seq=seq, applied=applied)
+        target.save_admins(group_id, source.load_admins(group_id))
+        owner_id = source.load_owner(group_id)
+        if owner_id is not None:
+            target.save_owner(group_id, owner_id)
+        target.save_usernames(group_id, source.load_usernames(group_id))
+        for week, standings in reversed(source.load_history(group_id)):
+            target.archive_week(group_id, week, standings)
+    registry = source.load_registry()
+    if registry:
+        target.save_registry(registry, set(registry))
+
+    target.set_meta('json_migrated_at', datetime.datetime.now(pytz.UTC).isoformat())
+    log.info(f"📦 Migrated {len(group_ids)} groups from {GROUPS_DATA_DIR} to {target.path}")
+    return len(group_ids)
+
+class MeteredStorage:
+    """Wraps a storage backend to count and time every call by operation."""
+
+    READ_PREFIXES = ('load', 'list', 'get')
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, attr: str):
+        value = getattr(self.backend, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+        kind = 'read' if attr.startswith(self.READ_PREFIXES) else 'write'
+
+        def metered(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                storage_operations.inc(self.name, attr)
+                storage_seconds.observe(time.perf_counter() - start, self.name, kind)
+
+        # Cache the wrapper so later lookups skip __getattr__
+        setattr(self, attr, metered)
+        return metered
+
+def open_storage(backend: str):
+    if backend == 'sqlite':
+        sqlite_storage = SqliteStorage(SQLITE_PATH)
+        migrate_json_to_sqlite(sqlite_storage)
+        return MeteredStorage(sqlite_storage)
+    if backend != 'json':
+        log.warning(f"⚠️ Unknown STORAGE_BACKEND '{backend}', falling back to json")
+    return MeteredStorage(JsonStorage())
+
+storage = open_storage(STORAGE_BACKEND)
+log.info(f"🗄️ Storage backend: {storage.name}")
+
+# === Background flushing ===
+class PeriodicFlusher:
+    """
+    Base for state that is written back in batches: flush() runs every
+    flush_interval seconds once start() is called, and once more on stop().
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._flush_task = None
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _stop_loop(self) -> bool:
+        """Cancel the background flusher; returns False if it was never started."""
+        if not self._flush_task:
+            return False
+        self._flush_task.cancel()
+        try:
+            await self._flush_task
+        except asyncio.CancelledError:
+            pass
+        self._flush_task = None
+        return True
+
+    async def stop(self):
+        await self._stop_loop()
+        await self.flush()
+
+# === Points journal ===
+class PointsJournal(PeriodicFlusher):
+    """
+    Append-only log of every point change, one compact JSON line per entry
+    tagged with a sequence number. Lines are buffered and fsynced in batches.
+    The log is split into segments named after their first seq, so compaction
+    can delete the segments that the points snapshots already cover.
+    """
+
+    def __init__(self, directory: Path, sync_interval: float):
+        super().__init__(sync_interval)
+        self.directory = directory
+        self._seq = 0
+        self._buffer = []
+        self._segment_start = None
+        self._file = None
+        # Bytes across all segments still on disk
+        self.size = 0
+        self._lock = None
+
+    def _segments(self) -> list:
+        segments = []
+        for path in self.directory.glob('points.*.log'):
+            try:
+                segments.append((int(path.name.split('.')[1]), path))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def recover(self):
+        """Yield every entry still on disk, oldest first. Call before open()."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for start, path in self._segments():
+            self._seq = max(self._seq, start - 1)
+            self.size += path.stat().st_size
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A crash mid-append leaves at most a torn last line
+                        log.warning(f"⚠️ Skipping damaged journal line in {path.name}")
+                        continue
+                    self._seq = max(self._seq, entry['s'])
+                    yield entry
+
+    def open(self):
+        """Start a fresh segment to append to."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Seqs also follow the clock, so they keep increasing past any
+        # snapshot even if the journal directory was lost
+        self._seq = max(self._seq, time.time_ns() // 1000)
+        self._open_segment()
+
+    def _open_segment(self):
+        self._segment_start = self._seq + 1
+        self._file = open(self.directory / f'points.{self._segment_start}.log', 'a')
+
+    def append(self, group_id: int, op: str, deltas: list, action: str,
+               by=None, message_id=None, undoes=None, update_id=None) -> dict:
+        """Record a change and return the entry; it reaches disk on the next sync."""
+        self._seq += 1
+        entry = {'s': self._seq, 'g': group_id, 'o': op, 'd': deltas, 'a': action, 't': int(time.time())}
+        if by is not None:
+            entry['b'] = by
+        if message_id is not None:
+            entry['m'] = message_id
+        if undoes is not None:
+            entry['u'] = undoes
+        if update_id is not None:
+            entry['n'] = update_id
+        self._buffer.append(json.dumps(entry, separators=(',', ':')) + "\n")
+        return entry
+
+    def _write(self, lines: list):
+        data = "".join(lines)
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        written = len(data.encode())
+        self.size += written
+        storage_bytes.inc('written', amount=written)
+
+    async def sync(self):
+        """Write and fsync everything appended so far."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            await self._sync_locked()
+
+    async def _sync_locked(self):
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await asyncio.to_thread(self._write, lines)
+        except Exception as e:
+            log.error(f"❌ Error writing {len(lines)} journal entries: {e}")
+            self._buffer = lines + self._buffer
+
+    async def rotate(self) -> int:
+        """Close the current segment and start a new one; returns the new segment's first seq."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            await self._sync_locked()
+            self._file.close()
+            self._open_segment()
+            return self._segment_start
+
+    def discard_before(self, start: int):
+        """Delete the segments that only hold entries older than start."""
+        for segment_start, path in self._segments():
+            if segment_start < start:
+                self.size -= path.stat().st_size
+                path.unlink()
+
+    async def flush(self):
+        await self.sync()
+
+    async def stop(self):
+        await super().stop()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+points_journal = PointsJournal(SHARD_JOURNAL_DIR, JOURNAL_SYNC_INTERVAL)
+
+# === Compact per-group points ===
+def as_number(value: float):
+    # Whole totals read back as ints, the way the SQLite backend returns them
+    return int(value) if value.is_integer() else value
+
+class GroupPoints:
+    """
+    One group's points as parallel int64/float64 arrays sorted by user id:
+    16 bytes a member, where a {str(user_id): float} dict needs well over 100.
+    """
+
+    __slots__ = ('user_ids', 'values')
+
+    def __init__(self, points: dict = None):
+        items = sorted((int(user_id), pts) for user_id, pts in (points or {}).items())
+        self.user_ids = array('q', [user_id for user_id, _ in items])
+        self.values = array('d', [pts for _, pts in items])
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def get(self, user_id: int, default=None):
+        index = bisect.bisect_left(self.user_ids, user_id)
+        if index < len(self.user_ids) and self.user_ids[index] == user_id:
+            return as_number(self.values[index])
+        return default
+
+    def add(self, user_id: int, delta: float):
+        """Add delta to a member's total; returns (old_total_or_None, new_total)."""
+        index = bisect.bisect_left(self.user_ids, user_id)
+        if index < len(self.user_ids) and self.user_ids[index] == user_id:
+            old = self.values[index]
+            self.values[index] = old + delta
+            return as_number(old), as_number(self.values[index])
+        self.user_ids.insert(index, user_id)
+        self.values.insert(index, delta)
+        return None, as_number(float(delta))
+
+    def items(self):
+        """(user_id, points) pairs with int user ids."""
+        return zip(self.user_ids, map(as_number, self.values))
+
+    def to_dict(self) -> dict:
+        """The {str(user_id): points} form storage reads and writes."""
+        return {str(user_id): pts for user_id, pts in self.items()}
+
+# === Write-behind points store ===
+points_cache_lookups = metrics.counter(
+    'mechabdol_points_cache_lookups_total', 'Group points lookups by whether the group was resident.', ('result',)
+)
+points_cache_evictions = metrics.counter(
+    'mechabdol_points_cache_evictions_total', 'Groups evicted from memory, by reason.', ('reason',)
+)
+
+class PointsStore(PeriodicFlusher):
+    """
+    Keeps each group's points resident in memory after the first load.
+    Every change is journaled, applied in memory, and the dirty groups are
+    written back in batches, on a timer or once enough changes pile up, off
+    the event loop. Each snapshot records the last journal seq it includes
+    and the update and message ids of the latest changes, so a redelivered
+    update can be recognised after a restart.
+
+    Resident groups form an LRU within a memory budget: after each flush the
+    least recently used clean groups are evicted until the estimate fits,
+    along with any group idle for longer than idle_evict. An evicted group
+    reloads from storage on its next use (its /undo history goes with it,
+    as it does when the journal is compacted across a restart).
+    """
+
+    # Actions /undo can reverse; resets and weekly carry-overs can't be
+    UNDOABLE_ACTIONS = ('reply', 'test')
+
+    # Rough resident cost: per group (arrays, LRU and bookkeeping entries),
+    # per member in the arrays, and per member of a built ranking
+    GROUP_BYTES = 600
+    MEMBER_BYTES = 16
+    RANKED_MEMBER_BYTES = 120
+
+    def __init__(self, flush_interval: float, max_pending: int, journal: PointsJournal,
+                 memory_budget: int = POINTS_MEMORY_BUDGET, idle_evict: float = POINTS_IDLE_EVICT):
+        super().__init__(flush_interval)
+        self.max_pending = max_pending
+        self.journal = journal
+        self.memory_budget = memory_budget
+        self.idle_evict = idle_evict
+        self._groups = {}
+        # group_id -> last use (monotonic), least recently used first
+        self._lru = OrderedDict()
+        self._members = 0
+        self._ranked_members = 0
+        # group_id -> last journal seq applied to the group
+        self._seqs = {}
+        # group_id -> {user_id_str: delta since the last flush}
+        self._dirty = {}
+        self._reset = set()
+        self._pending = 0
+        # group_id -> SortedList of (-points, user_id), built on first use
+        self._rankings = {}
+        # group_id -> deque of recent undoable journal entries
+        self._history = {}
+        # group_id -> deque of (update_id, message_id) of the latest changes
+        self._applied = {}
+        # group_id -> version, bumped from one store-wide counter on every
+        # change (and on load), so a version never repeats for a group
+        self._versions = {}
+        self._version = 0
+        # Other per-group caches sharing the LRU and memory budget
+        self._companions = []
+        self._wakeup = None
+        self._flush_lock = None
+
+    def attach(self, cache):
+        """
+        Evict another per-group cache along with the points. It calls touch()
+        whenever it uses a group and provides resident_bytes, is_dirty(group_id)
+        and forget(group_id).
+        """
+        self._companions.append(cache)
+
+    def touch(self, group_id: int):
+        """Mark a group as just used, without loading its points."""
+        self._lru[group_id] = time.monotonic()
+        self._lru.move_to_end(group_id)
+
+    def get(self, group_id: int) -> GroupPoints:
+        """Return the live points for a group (treat them as read-only)."""
+        points = self._groups.get(group_id)
+        if points is None:
+            points_cache_lookups.inc('miss')
+            snapshot, self._seqs[group_id], applied = storage.load_snapshot(group_id)
+            points = self._groups[group_id] = GroupPoints(snapshot)
+            self._applied[group_id] = deque(applied, maxlen=REPLAY_WINDOW)
+            self._bump(group_id)
+            self._members += len(points)
+            if self.total_resident_bytes > self.memory_budget and self._wakeup is not None:
+                self._wakeup.set()
+        else:
+            points_cache_lookups.inc('hit')
+        self.touch(group_id)
+        return points
+
+    def snapshot(self, group_id: int) -> dict:
+        """A {user_id: points} copy of a group's points."""
+        return dict(self.get(group_id).items())
+
+    def version(self, group_id: int) -> int:
+        """Changes whenever the group's points do; equal versions mean equal rankings."""
+        self.get(group_id)
+        return self._versions[group_id]
+
+    def _bump(self, group_id: int):
+        self._version += 1
+        self._versions[group_id] = self._version
+
+    @property
+    def resident_bytes(self) -> int:
+        return (len(self._groups) * self.GROUP_BYTES + self._members * self.MEMBER_BYTES
+                + self._ranked_members * self.RANKED_MEMBER_BYTES)
+
+    @property
+    def total_resident_bytes(self) -> int:
+        return self.resident_bytes + sum(cache.resident_bytes for cache in self._companions)
+
+    def resident_groups(self) -> int:
+        return len(self._groups)
+
+    def apply(self, group_id: int, deltas: list, action: str, by=None, message_id=None, undoes=None,
+              update_id=None) -> list:
+        """Journal and apply a batch of (user_id, delta) pairs; returns the new totals in order."""
+        self.get(group_id)
+        entry = self.journal.append(group_id, 'add', deltas, action, by, message_id, undoes, update_id)
+        self._seqs[group_id] = entry['s']
+        self._remember(group_id, entry)
+        self._mark_applied(group_id, entry)
+        return [self._add(group_id, user_id, delta) for user_id, delta in deltas]
+
+    def reset(self, group_id: int, carry: list = (), action: str = 'reset', by=None, message_id=None,
+              update_id=None):
+        """Journal and apply a reset, then re-add the carried (user_id, delta) pairs."""
+        self.get(group_id)
+        entry = self.journal.append(group_id, 'reset', list(carry), action, by, message_id, None, update_id)
+        self._seqs[group_id] = entry['s']
+        self._remember(group_id, entry)
+        self._mark_applied(group_id, entry)
+        self._clear(group_id)
+        for user_id, delta in carry:
+            self._add(group_id, user_id, delta)
+
+    def already_applied(self, group_id: int, message_id: int) -> bool:
+        """Whether a change triggered by this message is already in the group's points."""
+        self.get(group_id)
+        return any(applied == message_id for _, applied in self._applied[group_id])
+
+    def _mark_applied(self, group_id: int, entry: dict):
+        if 'm' in entry:
+            self._applied[group_id].append((entry.get('n', 0), entry['m']))
+
+    def last_action(self, group_id: int):
+        """Return the group's most recent undoable journal entry, or None."""
+        history = self._history.get(group_id)
+        return history[-1] if history else None
+
+    def _add(self, group_id: int, user_id: int, delta: float) -> float:
+        old, total = self._groups[group_id].add(user_id, delta)
+        self._bump(group_id)
+        if old is None:
+            self._members += 1
+        ranking = self._rankings.get(group_id)
+        if ranking is not None:
+            if old is not None:
+                ranking.remove((-old, user_id))
+            else:
+                self._ranked_members += 1
+            ranking.add((-total, user_id))
+        deltas = self._mark_dirty(group_id)
+        key = str(user_id)
+        deltas[key] = deltas.get(key, 0) + delta
+        return total
+
+    def _drop(self, group_id: int):
+        # Forget a group's resident points and the ranking built on them
+        points = self._groups.pop(group_id, None)
+        if points is not None:
+            self._members -= len(points)
+        ranking = self._rankings.pop(group_id, None)
+        if ranking is not None:
+            self._ranked_members -= len(ranking)
+
+    def _clear(self, group_id: int):
+        self._drop(group_id)
+        self._groups[group_id] = GroupPoints()
+        self._bump(group_id)
+        self._mark_dirty(group_id).clear()
+        self._reset.add(group_id)
+
+    def _remember(self, group_id: int, entry: dict):
+        if entry['o'] == 'reset':
+            # Totals from before a reset are gone, so nothing older can be undone
+            self._history.pop(group_id, None)
+        elif entry['a'] == 'undo':
+            history = self._history.get(group_id)
+            if history and history[-1]['s'] == entry.get('u'):
+                history.pop()
+        elif entry['a'] in self.UNDOABLE_ACTIONS:
+            self._history.setdefault(group_id, deque(maxlen=UNDO_HISTORY)).append(entry)
+
+    def recover(self):
+        """Replay the journal on top of the stored snapshots, then open it for appends."""
+        replayed = 0
+        for entry in self.journal.recover():
+            group_id = entry['g']
+            self.get(group_id)
+            self._remember(group_id, entry)
+            if entry['s'] <= self._seqs[group_id]:
+                continue  # Already in the snapshot
+            if entry['o'] == 'reset':
+                self._clear(group_id)
+            for user_id, delta in entry['d']:
+                self._add(group_id, user_id, delta)
+            self._seqs[group_id] = entry['s']
+            self._mark_applied(group_id, entry)
+            replayed += 1
+        self.journal.open()
+        if replayed:
+            log.info(f"📜 Replayed {replayed} journal entries on top of the points snapshots")
+
+    def _ranking(self, group_id: int) -> SortedList:
+        points = self.get(group_id)
+        ranking = self._rankings.get(group_id)
+        if ranking is None:
+            ranking = SortedList((-pts, user_id) for user_id, pts in points.items())
+            self._rankings[group_id] = ranking
+            self._ranked_members += len(ranking)
+        return ranking
+
+    def count(self, group_id: int) -> int:
+        return len(self.get(group_id))
+
+    def top(self, group_id: int, n: int, start: int = 0) -> list:
+        """Return up to n (user_id, points) pairs in rank order, starting at 0-based rank start."""
+        return [(user_id, -neg_pts) for neg_pts, user_id in self._ranking(group_id).islice(start, start + n)]
+
+    def rank_of(self, group_id: int, user_id: int):
+        """Return a user's 0-based rank, or None if they have no entry."""
+        pts = self.get(group_id).get(user_id)
+        if pts is None:
+            return None
+        return self._ranking(group_id).index((-pts, user_id))
+
+    def _mark_dirty(self, group_id: int) -> dict:
+        deltas = self._dirty.setdefault(group_id, {})
+        self._pending += 1
+        if self._pending >= self.max_pending and self._wakeup is not None:
+            self._wakeup.set()
+        return deltas
+
+    async def flush(self) -> bool:
+        """Write every dirty group to disk in a worker thread; returns False if any write failed."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._dirty:
+                return True
+            # Snapshot on the loop so handlers can keep mutating meanwhile
+            snapshot = {
+                group_id: (
+                    self._groups[group_id].to_dict(), deltas, group_id in self._reset,
+                    self._seqs[group_id], list(self._applied[group_id])
+                )
+                for group_id, deltas in self._dirty.items()
+            }
+            self._dirty = {}
+            self._reset = set()
+            self._pending = 0
+            try:
+                await asyncio.to_thread(self._write_snapshot, snapshot)
+            except Exception as e:
+                log.error(f"❌ Error flushing points for {len(snapshot)} groups: {e}")
+                self._requeue(snapshot)
+                return False
+            return True
+
+    def _requeue(self, snapshot: dict):
+        # Fold the failed batch back under anything that changed meanwhile
+        for group_id, (_, deltas, reset, _, _) in snapshot.items():
+            if group_id in self._reset:
+                continue
+            pending = self._dirty.setdefault(group_id, {})
+            for key, delta in deltas.items():
+                pending[key] = pending.get(key, 0) + delta
+            if reset:
+                self._reset.add(group_id)
+            self._pending += 1
+
+    @staticmethod
+    def _write_snapshot(snapshot: dict):
+        for group_id, (points, deltas, reset, seq, applied) in snapshot.items():
+            storage.write_points(group_id, points, deltas, reset, seq, applied)
+
+    async def compact(self) -> bool:
+        """Fold the journal into fresh snapshots and drop the segments they cover."""
+        start = await self.journal.rotate()
+        # Everything before the new segment is in memory, so once this flush
+        # lands the older segments are no longer needed
+        if not await self.flush():
+            return False
+        await asyncio.to_thread(self.journal.discard_before, start)
+        return True
+
+    def evict(self):
+        """
+        Evict clean groups that are idle or over the memory budget, least
+        recently used first, from the points and every attached cache.
+        """
+        if self._flush_lock is not None and self._flush_lock.locked():
+            # A flush in progress has groups that are neither dirty nor on disk
+            return
+        idle_before = time.monotonic() - self.idle_evict
+        for group_id, last_used in list(self._lru.items()):
+            if last_used < idle_before:
+                reason = 'idle'
+            elif self.total_resident_bytes > self.memory_budget:
+                reason = 'budget'
+            else:
+                break
+            if group_id in self._dirty or any(cache.is_dirty(group_id) for cache in self._companions):
+                # Not on disk yet; it goes after a later flush
+                continue
+            del self._lru[group_id]
+            self._drop(group_id)
+            self._seqs.pop(group_id, None)
+            self._history.pop(group_id, None)
+            self._applied.pop(group_id, None)
+            self._versions.pop(group_id, None)
+            for cache in self._companions:
+                cache.forget(group_id)
+            points_cache_evictions.inc(reason)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.journal.size >= JOURNAL_COMPACT_BYTES:
+                await self.compact()
+            else:
+                await self.flush()
+            self.evict()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        super().start()
+
+    async def stop(self):
+        """Stop the background flusher and write out anything still pending."""
+        if not await self._stop_loop():
+            # Never started (startup failed before post_init), so nothing to write
+            return
+        await self.compact()
+        log.info("💾 Flushed pending points to disk")
+
+points_store = PointsStore(POINTS_FLUSH_INTERVAL, POINTS_FLUSH_MAX_PENDING, points_journal)
+
+# === Per-group serialized update pipeline ===
+class GroupPipeline:
+    """
+    Runs point changes for each group strictly in arrival order on one worker
+    task per active group, so concurrent updates never interleave a
+    read-modify-write. Different groups proceed in parallel, and a group's
+    worker exits after sitting idle so memory stays bounded.
+    """
+
+    def __init__(self, idle_timeout: float):
+        self.idle_timeout = idle_timeout
+        self._queues = {}
+        self._workers = {}
+
+    async def run(self, group_id: int, func, *args):
+        """Queue func(*args) behind the group's earlier jobs and return its result."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(group_id)
+        if queue is None:
+            queue = self._queues[group_id] = asyncio.Queue()
+            self._workers[group_id] = asyncio.create_task(self._worker(group_id, queue))
+        queue.put_nowait((func, args, future))
+        return await future
+
+    async def _worker(self, group_id: int, queue: asyncio.Queue):
+        while True:
+            try:
+                job = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+            except asyncio.TimeoutError:
+                # Nothing can be queued between this check and the removal,
+                # since there is no await in between
+                if queue.empty():
+                    del self._queues[group_id]
+                    del self._workers[group_id]
+                    return
+                continue
+
+            # Jobs run one at a time, each its own journal entry so /undo can
+            # reverse it; the disk writes are batched further down, where the
+            # journal syncs its buffer and the store flushes dirty groups
+            func, args, future = job
+            try:
+                if not future.cancelled():
+                    result = func(*args)
+                    if inspect.isawaitable(result):
+                        result = await result
+                    future.set_result(result)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def stop(self):
+        """Let every queued job finish, then stop the workers."""
+        for queue in list(self._queues.values()):
+            await queue.join()
+        for worker in list(self._workers.values()):
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._queues.clear()
+        self._workers.clear()
+
+group_pipeline = GroupPipeline(GROUP_WORKER_IDLE_TIMEOUT)
+
+# === Point changes (always run through group_pipeline) ===
+duplicate_updates = metrics.counter(
+    'mechabdol_duplicate_updates_total', 'Redelivered updates skipped because their point change was already applied.'
+)
+
+# Returned instead of a result when the triggering message was already applied
+REPLAYED = object()
+
+def is_replay(group_id: int, message_id, update_id) -> bool:
+    """
+    Whether this message already changed the group's points (Telegram
+    delivered it again). Checked inside the pipeline job, so two deliveries
+    being handled at once can't both get past it.
+    """
+    if message_id is None or not points_store.already_applied(group_id, message_id):
+        return False
+    duplicate_updates.inc()
+    log.info(
+        f"🔁 Skipping update {update_id}: message {message_id} in {group_id} was already applied",
+        extra={'group_id': group_id}
+    )
+    return True
+
+def award_points(group_id: int, deltas: list, action: str = 'reply', by=None, message_id=None,
+                 update_id=None):
+    """Apply a batch of (user_id, delta) pairs and return the new totals in order, or REPLAYED."""
+    if is_replay(group_id, message_id, update_id):
+        return REPLAYED
+    return points_store.apply(group_id, deltas, action, by, message_id, update_id=update_id)
+
+def subtract_point(group_id: int, user_id: int, by=None, message_id=None, update_id=None):
+    """Take one point away; returns the new total, None if the user has none, or REPLAYED."""
+    if is_replay(group_id, message_id, update_id):
+        return REPLAYED
+    if points_store.get(group_id).get(user_id, 0) <= 0:
+        return None
+    [total] = points_store.apply(group_id, [(user_id, -1)], 'reply', by, message_id, update_id=update_id)
+    return total
+
+def reset_points(group_id: int, by=None, message_id=None, update_id=None):
+    if is_replay(group_id, message_id, update_id):
+        return REPLAYED
+    points_store.reset(group_id, by=by, message_id=message_id, update_id=update_id)
+
+def carry_over_points(group_id: int, posted: dict):
+    """Clear the points that were posted, keeping anything awarded since."""
+    leftover = [(uid, round(pts - posted.get(uid, 0), 9)) for uid, pts in points_store.get(group_id).items()]
+    points_store.reset(group_id, [(uid, delta) for uid, delta in leftover if delta], 'weekly')
+
+def undo_last_action(group_id: int, by=None, message_id=None, update_id=None):
+    """
+    Reverse the group's most recent award, subtraction or test-score batch.
+    Returns (entry, new_totals) for the reversed journal entry, None, or REPLAYED.
+    """
+    if is_replay(group_id, message_id, update_id):
+        return REPLAYED
+    entry = points_store.last_action(group_id)
+    if entry is None:
+        return None
+    inverse = [(user_id, -delta) for user_id, delta in entry['d']]
+    return entry, points_store.apply(group_id, inverse, 'undo', by, message_id, entry['s'], update_id)
+
+# === Display name cache ===
+class DisplayNameCache:
+    """
+    Member display names keyed by (group_id, user_id), with a TTL and LRU
+    eviction. Filled passively from the users seen on incoming updates, so
+    leaderboards rarely need a get_chat_member call per row.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, group_id: int, user_id: int):
+        key = (group_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        name, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return name
+
+    def put(self, group_id: int, user_id: int, name: str):
+        key = (group_id, user_id)
+        self._entries[key] = (name, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def remember(self, group_id: int, user):
+        if user is not None and not user.is_bot:
+            self.put(group_id, user.id, user.full_name)
+
+name_cache = DisplayNameCache(NAME_CACHE_SIZE, NAME_CACHE_TTL)
+
+# === Username index ===
+class UsernameIndex(PeriodicFlusher):
+    """
+    Per-group map of lowercased username -> user_id, learned from every
+    message the bot sees and kept current when members rename. The Bot API
+    can't look members up by username, so this is how test-score lines get
+    resolved. Loaded lazily per group, written back in batches, and evicted
+    along with the group's points.
+    """
+
+    # Rough resident cost: per group (two dicts) and per learned username
+    GROUP_BYTES = 500
+    NAME_BYTES = 200
 
-# === Helper functions for file paths ===
-def get_group_points_file(group_id: int) -> Path:
-    return GROUPS_DATA_DIR / f'points_{group_id}.json'
+    def __init__(self, flush_interval: float):
+        super().__init__(flush_interval)
+        self._by_name = {}
+        self._by_user = {}
+        self._names = 0
+        self._dirty = set()
+        # Groups whose snapshot is being written right now
+        self._writing = set()
 
-def get_group_admins_file(group_id: int) -> Path:
-    return GROUPS_DATA_DIR / f'admins_{group_id}.json'
+    def _group(self, group_id: int) -> dict:
+        by_name = self._by_name.get(group_id)
+        if by_name is None:
+            by_name = self._by_name[group_id] = storage.load_usernames(group_id)
+            self._by_user[group_id] = {user_id: name for name, user_id in by_name.items()}
+            self._names += len(by_name)
+        points_store.touch(group_id)
+        return by_name
 
-def get_group_owner_file(group_id: int) -> Path:
-    return GROUPS_DATA_DIR / f'owner_{group_id}.txt'
+    @property
+    def resident_bytes(self) -> int:
+        return len(self._by_name) * self.GROUP_BYTES + self._names * self.NAME_BYTES
 
-# === Load group points ===
-def load_group_points(group_id: int) -> dict:
-    points_file = get_group_points_file(group_id)
-    if points_file.exists():
+    def is_dirty(self, group_id: int) -> bool:
+        return group_id in self._dirty or group_id in self._writing
+
+    def forget(self, group_id: int):
+        by_name = self._by_name.pop(group_id, None)
+        if by_name is not None:
+            self._names -= len(by_name)
+            del self._by_user[group_id]
+
+    def learn(self, group_id: int, user):
+        if user is None or user.is_bot:
+            return
+        by_name = self._group(group_id)
+        by_user = self._by_user[group_id]
+        username = user.username.lower() if user.username else None
+        old = by_user.get(user.id)
+        if old == username:
+            return
+        before = len(by_name)
+        # Renamed or dropped their username: forget the old handle
+        if old is not None and by_name.get(old) == user.id:
+            del by_name[old]
+        if username is None:
+            by_user.pop(user.id, None)
+        else:
+            # A handle freed by someone else may have been picked up by this user
+            previous_owner = by_name.get(username)
+            if previous_owner is not None:
+                by_user.pop(previous_owner, None)
+            by_name[username] = user.id
+            by_user[user.id] = username
+        self._names += len(by_name) - before
+        self._dirty.add(group_id)
+
+    def resolve(self, group_id: int, username: str):
+        return self._group(group_id).get(username.lstrip('@').lower())
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        snapshot = {group_id: dict(self._by_name[group_id]) for group_id in self._dirty}
+        self._dirty.clear()
+        self._writing = set(snapshot)
         try:
-            with open(points_file, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            print(f"⚠️ Could not load points file for group {group_id}")
-            return {}
-    return {}
+            await asyncio.to_thread(self._write_snapshot, snapshot)
+        except Exception as e:
+            log.error(f"❌ Error flushing usernames for {len(snapshot)} groups: {e}")
+            self._dirty.update(snapshot)
+        finally:
+            self._writing = set()
 
-# === Save group points ===
-def save_group_points(group_id: int, points: dict):
-    points_file = get_group_points_file(group_id)
-    with open(points_file, 'w') as f:
-        json.dump(points, f)
+    @staticmethod
+    def _write_snapshot(snapshot: dict):
+        for group_id, usernames in snapshot.items():
+            storage.save_usernames(group_id, usernames)
+
+username_index = UsernameIndex(POINTS_FLUSH_INTERVAL)
+points_store.attach(username_index)
+
+# === Group registry ===
+class GroupRegistry(PeriodicFlusher):
+    """
+    Manifest of the groups this process serves: when each was last active and
+    whether it gets the weekly leaderboard. Read from storage in one go at
+    startup, so no per-group data is opened until a group's first update.
+    Changes are written back in batches.
+    """
+
+    def __init__(self, flush_interval: float, activity_resolution: float):
+        super().__init__(flush_interval)
+        self.activity_resolution = activity_resolution
+        # group_id -> (last_active, weekly)
+        self._entries = {}
+        self._dirty = set()
+
+    def load(self) -> int:
+        entries = storage.load_registry()
+        if entries is None:
+            # No manifest yet: build it once from what's in storage
+            entries = {group_id: (0, True) for group_id in storage.list_groups()}
+            self._dirty.update(entries)
+            log.info(f"🗂️ Built the group registry from {len(entries)} stored groups")
+        self._entries = {group_id: entry for group_id, entry in entries.items() if owns_group(group_id)}
+        self._dirty &= self._entries.keys()
+        return len(self._entries)
+
+    def touch(self, group_id: int):
+        """Record activity in a group, registering it if it's new."""
+        now = int(time.time())
+        entry = self._entries.get(group_id)
+        if entry is None:
+            self._entries[group_id] = (now, True)
+        elif now - entry[0] >= self.activity_resolution:
+            self._entries[group_id] = (now, entry[1])
+        else:
+            return
+        self._dirty.add(group_id)
+
+    def set_weekly(self, group_id: int, weekly: bool):
+        last_active, current = self._entries.get(group_id, (int(time.time()), None))
+        if current != weekly:
+            self._entries[group_id] = (last_active, weekly)
+            self._dirty.add(group_id)
+
+    def weekly_groups(self) -> set:
+        return {group_id for group_id, (_, weekly) in self._entries.items() if weekly}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        entries = dict(self._entries)
+        changed = self._dirty
+        self._dirty = set()
+        try:
+            await asyncio.to_thread(storage.save_registry, entries, changed)
+        except Exception as e:
+            log.error(f"❌ Error saving the group registry ({len(changed)} changed groups): {e}")
+            self._dirty |= changed
+
+group_registry = GroupRegistry(REGISTRY_FLUSH_INTERVAL, GROUP_ACTIVITY_RESOLUTION)
+
+# === Learn names and usernames from incoming updates ===
+@instrumented
+async def remember_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs ahead of every other handler and only records who was seen."""
+    chat = update.effective_chat
+    if not chat or chat.type == 'private':
+        return
+    group_registry.touch(chat.id)
+    if update.chat_member:
+        name_cache.remember(chat.id, update.chat_member.new_chat_member.user)
+        username_index.learn(chat.id, update.chat_member.new_chat_member.user)
+        return
+    message = update.effective_message
+    if not message:
+        return
+
+    seen = [message.from_user]
+    if message.reply_to_message:
+        seen.append(message.reply_to_message.from_user)
+    for entity in message.entities or ():
+        if entity.type == 'text_mention':
+            seen.append(entity.user)
+    seen.extend(message.new_chat_members or ())
+
+    for user in seen:
+        name_cache.remember(chat.id, user)
+        username_index.learn(chat.id, user)
+
+# === Bot API rate limiting ===
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, bursting up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+class ChatBuckets:
+    """One TokenBucket per chat, created on first use with the same rate and capacity."""
+
+    # Past this many chats, idle buckets are dropped before adding another
+    PRUNE_ABOVE = 10000
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+
+    def get(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > self.PRUNE_ABOVE:
+                # Idle chats have refilled completely and carry no state worth keeping
+                self._buckets = {cid: b for cid, b in self._buckets.items() if not b.full}
+            bucket = self._buckets[chat_id] = TokenBucket(self.rate, self.capacity)
+        return bucket
+
+class ApiRateLimiter:
+    """
+    A bot-wide token bucket plus one bucket per chat for member lookups, and
+    a shared RetryAfter pause. Sends also wait for an Outbox.slot().
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float):
+        self.chat_rate = chat_rate
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._chats = ChatBuckets(chat_rate, max(1.0, chat_rate))
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Hold back every caller after Telegram answers with RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id: int):
+        await self._chats.get(chat_id).acquire()
+        await self._global.acquire()
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# Each chat belongs to one shard, but the bot-wide budget is split between them
+api_limiter = ApiRateLimiter(API_RATE_LIMIT / SHARDS, API_CHAT_RATE_LIMIT)
+
+# === Concurrent member lookups ===
+class MemberLookupExecutor:
+    """
+    Runs get_chat_member calls concurrently, at most `max_concurrency` at a
+    time and within the API rate limits. Retries after RetryAfter, and
+    concurrent requests for the same member share one call.
+    """
+
+    def __init__(self, limiter: ApiRateLimiter, max_concurrency: int, max_retries: int = 3):
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight = {}
+
+    async def lookup(self, bot, group_id: int, user_id: int):
+        """Return the member's User, or None if it can't be looked up."""
+        key = (group_id, user_id)
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.create_task(self._fetch(bot, group_id, user_id))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, bot, group_id: int, user_id: int):
+        async with self._semaphore:
+            for _ in range(self.max_retries + 1):
+                await self.limiter.acquire(group_id)
+                try:
+                    member = await bot.get_chat_member(group_id, user_id)
+                    return member.user
+                except RetryAfter as e:
+                    log.warning(
+                        f"⏳ RetryAfter {e.retry_after}s while looking up {user_id} in {group_id}",
+                        extra={'group_id': group_id, 'user_id': user_id}
+                    )
+                    self.limiter.pause(e.retry_after)
+                except TelegramError:
+                    return None
+        return None
+
+member_lookups = MemberLookupExecutor(api_limiter, LOOKUP_CONCURRENCY)
+
+# === Outgoing message queue ===
+def summarize_point_changes(changes) -> list:
+    """One line per member for (user_id, name, delta, total) changes, deltas summed, in first-seen order."""
+    merged = {}
+    for user_id, name, delta, total in changes:
+        previous = merged.get(user_id)
+        merged[user_id] = (name, delta + (previous[1] if previous else 0), total)
+    return [f"{'✅' if delta >= 0 else '❌'} {delta:+g} لـ {name} (المجموع: {total})"
+            for name, delta, total in merged.values()]
+
+class Outbox:
+    """
+    Per-chat outgoing queue that keeps each group under Telegram's limit of
+    about 20 messages a minute. Handlers enqueue and return immediately.
+    Command replies and errors go first. Point-award acknowledgements that pile
+    up while the chat is throttled are merged into one summary message.
+    """
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+
+    def __init__(self, per_minute: float, burst: float, idle_timeout: float):
+        self.per_minute = per_minute
+        self.burst = burst
+        self.idle_timeout = idle_timeout
+        self.bot = None
+        self._chats = {}
+        self._buckets = ChatBuckets(per_minute / 60, burst)
+        self._closing = False
+
+    def start(self, bot):
+        self.bot = bot
+        self._closing = False
+
+    def send(self, chat_id: int, text: str, reply_to: int = None, priority: int = PRIORITY_NORMAL,
+             reply_markup=None):
+        state = self._chat(chat_id)
+        state['queues'][priority].append((text, reply_to, reply_markup))
+        state['wakeup'].set()
+
+    def ack(self, chat_id: int, user_id: int, name: str, delta: float, total: float, text: str, reply_to: int = None):
+        """Queue a point-award acknowledgement that may be merged with others."""
+        state = self._chat(chat_id)
+        state['acks'].append((user_id, name, delta, total, text, reply_to))
+        state['wakeup'].set()
+
+    def queued(self) -> int:
+        """Messages and acknowledgements waiting across all chats."""
+        return sum(
+            len(state['queues'][0]) + len(state['queues'][1]) + len(state['acks'])
+            for state in self._chats.values()
+        )
+
+    async def slot(self, chat_id: int):
+        """Wait for a turn in the chat's message budget, for messages sent or edited outside the queue."""
+        await self._buckets.get(chat_id).acquire()
+
+    def _chat(self, chat_id: int) -> dict:
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = self._chats[chat_id] = {
+                'queues': (deque(), deque()),
+                'acks': [],
+                'wakeup': asyncio.Event(),
+            }
+            state['task'] = asyncio.create_task(self._worker(chat_id, state))
+        return state
+
+    @staticmethod
+    def _pending(state: dict) -> bool:
+        return bool(state['queues'][0] or state['queues'][1] or state['acks'])
+
+    @staticmethod
+    def _next_message(state: dict):
+        for queue in state['queues']:
+            if queue:
+                return queue.popleft()
+        acks, state['acks'] = state['acks'], []
+        if len(acks) == 1:
+            _, _, _, _, text, reply_to = acks[0]
+            return text, reply_to, None
+        
+        # Merge everything that piled up
+        lines = summarize_point_changes(ack[:4] for ack in acks)
+        return "📊 آخر تحديثات النقاط:\n" + "\n".join(lines), None, None
+
+    async def _worker(self, chat_id: int, state: dict):
+        while True:
+            if not self._pending(state):
+                if self._closing:
+                    break
+                state['wakeup'].clear()
+                try:
+                    await asyncio.wait_for(state['wakeup'].wait(), timeout=self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if not self._pending(state):
+                        break
+                continue
+
+            # Wait for a send slot first, so acks keep piling up (and get
+            # merged) for as long as the chat is throttled
+            await self.slot(chat_id)
+            await api_limiter.acquire(chat_id)
+            text, reply_to, reply_markup = self._next_message(state)
+            try:
+                await self.bot.send_message(
+                    chat_id=chat_id,
+                    text=text,
+                    reply_to_message_id=reply_to,
+                    allow_sending_without_reply=True,
+                    reply_markup=reply_markup
+                )
+            except RetryAfter as e:
+                log.warning(f"⏳ RetryAfter {e.retry_after}s while sending to {chat_id}", extra={'group_id': chat_id})
+                api_limiter.pause(e.retry_after)
+                state['queues'][self.PRIORITY_HIGH].appendleft((text, reply_to, reply_markup))
+            except TelegramError as e:
+                log.error(f"❌ Error sending message to {chat_id}: {e}", extra={'group_id': chat_id})
+        del self._chats[chat_id]
+
+    async def stop(self, timeout: float = 10):
+        """Send what is still queued (giving up after timeout seconds), then stop."""
+        self._closing = True
+        tasks = [state['task'] for state in self._chats.values()]
+        for state in self._chats.values():
+            state['wakeup'].set()
+        if tasks:
+            _, still_running = await asyncio.wait(tasks, timeout=timeout)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._chats.clear()
+
+outbox = Outbox(OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, GROUP_WORKER_IDLE_TIMEOUT)
+
+# === Catch-up after downtime ===
+class CatchUpSummary:
+    """
+    Point changes for messages sent before the bot started (the backlog
+    Telegram held while it was down) aren't acknowledged one by one. They are
+    collected per group and posted as one summary once that group's backlog
+    has been quiet for `delay` seconds.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.started_at = time.time()
+        self._changes = {}
+        self._last_change = {}
+        self._pending = {}
+
+    def is_backlog(self, message) -> bool:
+        return message.date.timestamp() < self.started_at
+
+    def record(self, group_id: int, user_id: int, name: str, delta: float, total: float):
+        self._changes.setdefault(group_id, []).append((user_id, name, delta, total))
+        self._last_change[group_id] = time.monotonic()
+        if group_id not in self._pending:
+            self._pending[group_id] = asyncio.create_task(self._send_when_quiet(group_id))
+
+    async def _send_when_quiet(self, group_id: int):
+        while (remaining := self._last_change[group_id] + self.delay - time.monotonic()) > 0:
+            await asyncio.sleep(remaining)
+        del self._pending[group_id]
+        self._send(group_id)
+
+    def _send(self, group_id: int):
+        changes = self._changes.pop(group_id, None)
+        self._last_change.pop(group_id, None)
+        if changes:
+            outbox.send(
+                group_id,
+                "📥 النقط اللي اتسجلت وأنا مش موجود:\n" + "\n".join(summarize_point_changes(changes))
+            )
+
+    def flush(self):
+        """Queue every pending summary now."""
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+        for group_id in list(self._changes):
+            self._send(group_id)
+
+catch_up_summary = CatchUpSummary(CATCH_UP_SUMMARY_DELAY)
+
+catch_up_updates = metrics.counter(
+    'mechabdol_catch_up_updates_total', 'Backlog updates replayed before polling started.'
+)
+
+def acknowledge_points(update: Update, user, delta: float, total: float, text: str):
+    """Reply to a point change, or fold it into the group's catch-up summary if it's from the backlog."""
+    group_id = update.effective_chat.id
+    if catch_up_summary.is_backlog(update.message):
+        catch_up_summary.record(group_id, user.id, user.full_name, delta, total)
+    else:
+        outbox.ack(group_id, user.id, user.full_name, delta, total, text, update.message.message_id)
+
+async def catch_up_backlog(application: Application) -> int:
+    """
+    Replay the updates Telegram held while the bot was down, before polling
+    starts. Each page is split by chat: chats run in parallel (at most
+    CATCH_UP_CONCURRENCY at a time) with each chat's updates in order, and
+    the page is only confirmed to Telegram once all of it has been handled.
+    Returns the number of updates replayed.
+    """
+    bot = application.bot
+    semaphore = asyncio.Semaphore(CATCH_UP_CONCURRENCY)
+
+    async def replay_chat(updates: list):
+        async with semaphore:
+            for update in updates:
+                await application.process_update(update)
+
+    started = time.monotonic()
+    offset = None
+    replayed = 0
+    chats = set()
+    try:
+        # getUpdates is refused while a webhook is set
+        await bot.delete_webhook()
+        while True:
+            updates = await bot.get_updates(offset=offset, timeout=0, limit=100, allowed_updates=Update.ALL_TYPES)
+            if not updates:
+                break
+            by_chat = {}
+            for update in updates:
+                chat = update.effective_chat
+                by_chat.setdefault(chat.id if chat else 0, []).append(update)
+            await asyncio.gather(*(replay_chat(chat_updates) for chat_updates in by_chat.values()))
+            chats.update(by_chat)
+            # Asking for the next page confirms this one
+            offset = updates[-1].update_id + 1
+            replayed += len(updates)
+            catch_up_updates.inc(amount=len(updates))
+            if len(updates) < 100:
+                break
+        if offset is not None:
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+    except TelegramError as e:
+        # Polling picks up from the last confirmed page
+        log.warning(f"⚠️ Catch-up stopped early after {replayed} updates: {e}")
+    catch_up_summary.flush()
+    if replayed:
+        log.info(f"📥 Caught up on {replayed} updates from {len(chats)} chats in {time.monotonic() - started:.1f}s")
+    return replayed
+
+# === Get members' display names ===
+async def get_display_names(context: ContextTypes.DEFAULT_TYPE, group_id: int, user_ids: list) -> dict:
+    """Map user_id -> display name for every member that could be resolved."""
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        name = name_cache.get(group_id, user_id)
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+
+    users = await asyncio.gather(
+        *(member_lookups.lookup(context.bot, group_id, user_id) for user_id in missing)
+    )
+    for user_id, user in zip(missing, users):
+        if user is not None:
+            name_cache.put(group_id, user_id, user.full_name)
+            names[user_id] = user.full_name
+    return names
+
+# === Admin/owner permission cache ===
+class PermissionCache:
+    """
+    Each group's owner and admins held in memory as a frozenset, loaded from
+    storage the first time the group is checked. ChatMember updates patch it
+    (and storage) incrementally, so a permission check never touches disk.
+    Every change is written through, so groups can be evicted at any time.
+    """
+
+    # Rough resident cost: per group (three dict entries) and per privileged
+    # member (held in two frozensets)
+    GROUP_BYTES = 700
+    MEMBER_BYTES = 100
+
+    def __init__(self):
+        self._owners = {}
+        self._admins = {}
+        self._privileged = {}
+        self._members = 0
+
+    def _load(self, group_id: int) -> frozenset:
+        privileged = self._privileged.get(group_id)
+        if privileged is None:
+            self._owners[group_id] = storage.load_owner(group_id)
+            self._admins[group_id] = frozenset(storage.load_admins(group_id))
+            privileged = self._rebuild(group_id)
+        points_store.touch(group_id)
+        return privileged
+
+    def _rebuild(self, group_id: int) -> frozenset:
+        owner_id = self._owners.get(group_id)
+        privileged = self._admins.get(group_id, frozenset())
+        if owner_id is not None:
+            privileged = privileged | {owner_id}
+        self._members += len(privileged) - len(self._privileged.get(group_id, ()))
+        self._privileged[group_id] = privileged
+        return privileged
+
+    @property
+    def resident_bytes(self) -> int:
+        return len(self._privileged) * self.GROUP_BYTES + self._members * self.MEMBER_BYTES
+
+    def is_dirty(self, group_id: int) -> bool:
+        return False
+
+    def forget(self, group_id: int):
+        privileged = self._privileged.pop(group_id, None)
+        if privileged is not None:
+            self._members -= len(privileged)
+            self._owners.pop(group_id, None)
+            self._admins.pop(group_id, None)
+
+    def contains(self, group_id: int, user_id: int) -> bool:
+        return user_id in self._load(group_id)
+
+    def set_group(self, group_id: int, owner_id, admin_ids) -> bool:
+        """
+        Replace a group's owner and admins after a full sync, persisting only
+        what changed. Returns True if anything did.
+        """
+        self._load(group_id)
+        admins = frozenset(admin_ids)
+        changed = False
+        if owner_id is not None and owner_id != self._owners.get(group_id):
+            self._owners[group_id] = owner_id
+            storage.save_owner(group_id, owner_id)
+            changed = True
+        if admins != self._admins[group_id]:
+            self._admins[group_id] = admins
+            storage.save_admins(group_id, list(admins))
+            changed = True
+        self._rebuild(group_id)
+        return changed
+
+    def apply_status(self, group_id: int, user_id: int, status: str) -> bool:
+        """Apply one member's new status; returns True if the group's permissions changed."""
+        self._load(group_id)
+        owner_id = self._owners.get(group_id)
+        admins = self._admins[group_id]
+
+        if status == ChatMember.OWNER:
+            new_owner, new_admins = user_id, admins - {user_id}
+        elif status == ChatMember.ADMINISTRATOR:
+            new_owner = None if owner_id == user_id else owner_id
+            new_admins = admins | {user_id}
+        else:
+            new_owner = None if owner_id == user_id else owner_id
+            new_admins = admins - {user_id}
+
+        if new_owner == owner_id and new_admins == admins:
+            return False
+        if new_owner != owner_id:
+            storage.save_owner(group_id, new_owner)
+            self._owners[group_id] = new_owner
+        if new_admins != admins:
+            storage.save_admins(group_id, list(new_admins))
+            self._admins[group_id] = new_admins
+        self._rebuild(group_id)
+        return True
+
+permission_cache = PermissionCache()
+points_store.attach(permission_cache)
 
 # === Check if user is admin or owner ===
 async def is_admin_or_owner(context: ContextTypes.DEFAULT_TYPE, group_id: int, user_id: int) -> bool:
-    # Check if user is owner
-    owner_file = get_group_owner_file(group_id)
-    if owner_file.exists():
-        try:
-            with open(owner_file, 'r') as f:
-                owner_id = int(f.read().strip())
-            if user_id == owner_id:
-                return True
-        except (ValueError, FileNotFoundError):
-            pass
-    
-    # Check if user is admin
-    admins_file = get_group_admins_file(group_id)
-    if admins_file.exists():
-        try:
-            with open(admins_file, 'r') as f:
-                admins = json.load(f)
-            return user_id in admins
-        except:
-            pass
-    
-    return False
+    return permission_cache.contains(group_id, user_id)
+
+# === Track promotions and demotions ===
+@instrumented
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.chat_member
+    if change.chat.type not in ['group', 'supergroup']:
+        return
+    user = change.new_chat_member.user
+    if permission_cache.apply_status(change.chat.id, user.id, change.new_chat_member.status):
+        log.info(
+            f"🔐 Permissions updated in group {change.chat.id}: {user.id} is now {change.new_chat_member.status}",
+            extra={'group_id': change.chat.id}
+        )
+        # Reconcile with the full admin list once the burst of changes settles
+        admin_sync.request(context.application, change.chat.id)
 
 # === Check if command is allowed in private chat ===
 def is_private_chat_allowed(command: str) -> bool:
     return command == 'start'
 
 # === Parse test scores from message ===
-def parse_test_scores(message_text: str) -> list:
+# Pattern to match: @username score or username score
+# Also handles mentions like @user_name 5 or user_name 5
+SCORE_PATTERN = re.compile(r'(@?\w+)[^\S\n]+(\d+(?:\.\d+)?)')
+
+ScoreLine = namedtuple('ScoreLine', ['line_no', 'username', 'score'])
+
+def parse_test_scores(message_text: str) -> tuple:
     """
-    Parse test scores from a multi-line message.
+    Parse test scores from a multi-line message in a single pass.
     Expected format: @username score or username score
-    Returns list of tuples (username, score)
+    Returns (scores, malformed): a ScoreLine for every line that matched, and
+    (line_no, text) for every non-empty line that didn't. Lines are numbered
+    from 0 over the unmodified text, the same way index_text_mentions does.
     """
-    lines = message_text.strip().split('\n')
     scores = []
+    malformed = []
+    search = SCORE_PATTERN.search
+    length = len(message_text)
+    start = 0
+    line_no = 0
     
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        # Pattern to match: @username score or username score
-        # Also handles mentions like @user_name 5 or user_name 5
-        pattern = r'(@?\w+)\s+(\d+(?:\.\d+)?)'
-        match = re.search(pattern, line)
+    while start <= length:
+        end = message_text.find('\n', start)
+        if end == -1:
+            end = length
         
+        # Search the line in place instead of slicing it out
+        match = search(message_text, start, end)
         if match:
             username = match.group(1).lstrip('@')  # Remove @ if present
-            try:
-                score = float(match.group(2))
-                scores.append((username, score))
-            except ValueError:
-                continue
+            scores.append(ScoreLine(line_no, username, float(match.group(2))))
+        elif end > start and not message_text[start:end].isspace():
+            malformed.append((line_no, message_text[start:end].strip()))
+        
+        start = end + 1
+        line_no += 1
+    
+    return scores, malformed
+
+# === Map text mentions to message lines ===
+def index_text_mentions(message_text: str, entities) -> dict:
+    """
+    Map line_no -> User for every text_mention entity. Entity offsets count
+    UTF-16 code units, so line starts are converted once and each entity is
+    placed with a binary search.
+    """
+    mentions = [entity for entity in entities or () if entity.type == 'text_mention']
+    if not mentions:
+        return {}
     
-    return scores
+    line_starts = []
+    offset = 0
+    for line in message_text.split('\n'):
+        line_starts.append(offset)
+        offset += len(line.encode('utf-16-le')) // 2 + 1
+    
+    by_line = {}
+    for entity in mentions:
+        by_line.setdefault(bisect.bisect_right(line_starts, entity.offset) - 1, entity.user)
+    return by_line
 
 # === Get user ID from username ===
-async def get_user_id_from_username(context: ContextTypes.DEFAULT_TYPE, group_id: int, username: str) -> int:
+def get_user_id_from_username(group_id: int, username: str) -> int:
     """
-    Try to get user ID from username by checking recent messages or mentions.
-    This is a simplified approach - in practice, you might want to maintain a username->ID mapping.
+    Look the username up in the index learned from this group's messages.
+    Returns None if the user hasn't been seen with that username yet.
     """
-    try:
-        # Try to get chat member by username (this works for some cases)
-        member = await context.bot.get_chat_member(group_id, f"@{username}")
-        return member.user.id
-    except:
-        # If that fails, we'll need to return None and handle it in the calling function
-        return None
+    return username_index.resolve(group_id, username)
 
 # === Handle test scores message ===
+@instrumented
 async def handle_test_scores(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handle multi-line test scores message from admin.
@@ -142,63 +2542,53 @@ async def handle_test_scores(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     # Parse test scores from the message
-    scores = parse_test_scores(message_text)
+    scores, malformed = parse_test_scores(message_text)
     
     if not scores:
         return  # No valid scores found, don't respond
     
     group_id = update.effective_chat.id
+    mentions = index_text_mentions(message_text, update.message.entities)
     
-    # Load current points for this group
-    points = load_group_points(group_id)
-    
-    # Process each score
-    successful_updates = []
+    # Resolve each score line to a user
+    resolved = []
     failed_updates = []
     
-    for username, score in scores:
-        # First, try to find the user ID from entities (mentions)
-        user_id_found = None
+    for line_no, username, score in scores:
+        # A text mention on the line carries the user directly
+        mentioned = mentions.get(line_no)
+        user_id_found = mentioned.id if mentioned else None
         
-        # Check if there are any mentions in the message
-        if update.message.entities:
-            for entity in update.message.entities:
-                if entity.type == 'mention':
-                    mention_text = message_text[entity.offset:entity.offset + entity.length]
-                    if mention_text.lower() == f"@{username.lower()}":
-                        # This is a mention, but we still need to get the user ID
-                        # Try to get user ID from username
-                        user_id_found = await get_user_id_from_username(context, group_id, username)
-                        break
-                elif entity.type == 'text_mention':
-                    # Direct mention with user object
-                    mention_text = message_text[entity.offset:entity.offset + entity.length]
-                    if mention_text.lower() == f"@{username.lower()}" or mention_text.lower() == username.lower():
-                        user_id_found = entity.user.id
-                        break
-        
-        # If we couldn't find user ID from mentions, try to get it from username
+        # Otherwise look the username up in the learned index
         if user_id_found is None:
-            user_id_found = await get_user_id_from_username(context, group_id, username)
+            user_id_found = get_user_id_from_username(group_id, username)
         
         if user_id_found:
-            user_id_str = str(user_id_found)
-            points[user_id_str] = points.get(user_id_str, 0) + score
-            
-            # Get user's name for the response
-            try:
-                user = await context.bot.get_chat_member(group_id, user_id_found)
-                display_name = user.user.full_name
-            except:
-                display_name = username
-            
-            successful_updates.append(f"✅ {display_name}: +{score} نقطة (المجموع: {points[user_id_str]})")
+            resolved.append((username, user_id_found, score))
         else:
             failed_updates.append(f"❌ {username}: لم يتم العثور على المستخدم")
     
-    # Save updated points if there were successful updates
-    if successful_updates:
-        save_group_points(group_id, points)
+    # Apply all the scores as one ordered batch for this group
+    totals = []
+    if resolved:
+        totals = await group_pipeline.run(
+            group_id, award_points, group_id, [(user_id, score) for _, user_id, score in resolved],
+            'test', update.message.from_user.id, update.message.message_id, update.update_id
+        )
+        if totals is REPLAYED:
+            return
+    
+    # Get users' names for the response
+    names = await get_display_names(context, group_id, [user_id for _, user_id, _ in resolved])
+    backlog = catch_up_summary.is_backlog(update.message)
+    successful_updates = []
+    for (username, user_id_found, score), total in zip(resolved, totals):
+        display_name = names.get(user_id_found, username)
+        if backlog:
+            # Only what went wrong gets its own reply
+            catch_up_summary.record(group_id, user_id_found, display_name, score, total)
+        else:
+            successful_updates.append(f"✅ {display_name}: +{score} نقطة (المجموع: {total})")
     
     # Send response if there were any score updates attempted
     if successful_updates or failed_updates:
@@ -214,9 +2604,17 @@ async def handle_test_scores(update: Update, context: ContextTypes.DEFAULT_TYPE)
             response_lines.append("⚠️ لم يتم العثور على:")
             response_lines.extend(failed_updates)
         
-        await update.message.reply_text("\n".join(response_lines))
+        if malformed:
+            response_lines.append("")
+            response_lines.append("❓ سطور مش مفهومة (المفروض: يوزر وبعده الدرجة):")
+            response_lines.extend(f"{line_no + 1}: {text}" for line_no, text in malformed[:MAX_REPORTED_MALFORMED_LINES])
+            if len(malformed) > MAX_REPORTED_MALFORMED_LINES:
+                response_lines.append(f"... وكمان {len(malformed) - MAX_REPORTED_MALFORMED_LINES}")
+        
+        outbox.send(group_id, "\n".join(response_lines), update.message.message_id)
 
 # === /start command ===
+@instrumented
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👋 أهلاً وسهلاً! أنا بوت النقط!\n\n"
@@ -227,7 +2625,11 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "4. هنشر قايمة المتصدرين كل يوم سبت\n\n"
         "الأوامر (الجروبات بس):\n"
         "/dash - عرض قايمة المتصدرين دلوقتي\n"
-        "/reset - مسح النقط كلها (الأدمنز/صاحب الجروب بس)\n\n"
+        "/rank - ترتيبك وترتيب اللي حواليك\n"
+        "/history - قوايم الأسابيع اللي فاتت\n"
+        "/alltime - مجموع النقط من الأول\n"
+        "/reset - مسح النقط كلها (الأدمنز/صاحب الجروب بس)\n"
+        "/undo - إلغاء آخر تعديل نقط (الأدمنز/صاحب الجروب بس)\n\n"
         f"زيادة نقط: {', '.join(KEYWORDS)}\n"
         f"نقص نقط: {', '.join(SUBTRACT_KEYWORDS)}\n\n"
         "📝 إضافة نقاط امتحانات:\n"
@@ -237,7 +2639,110 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "username3 78"
     )
 
+# === Format leaderboard rows ===
+async def format_leaderboard(context: ContextTypes.DEFAULT_TYPE, group_id: int, entries: list, start: int = 0) -> list:
+    """Render (user_id, points) pairs ranked from 0-based position start as leaderboard lines."""
+    names = await get_display_names(context, group_id, [user_id for user_id, _ in entries])
+    leaderboard = []
+    
+    for idx, (uid, pts) in enumerate(entries, start=start):
+        name = names.get(uid, f"يوزر {uid}")
+        leaderboard.append(f"{idx+1}. {name} - {pts} نقطة")
+        
+        # Add emoji indicators for top 3
+        if idx < 3:
+            leaderboard[-1] = ("🥇 ", "🥈 ", "🥉 ")[idx] + leaderboard[-1]
+    
+    return leaderboard
+
+# Telegram rejects message text longer than this, counted in UTF-16 code units
+MESSAGE_MAX_LENGTH = 4096
+
+def message_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+def fit_leaderboard(header: str, lines: list, total: int) -> str:
+    """
+    Join a leaderboard's header and lines, keeping as many lines as fit in one
+    message; the members left out of `total` are counted on a last line.
+    """
+    reserve = message_length(f"\n\n... وكمان {total}")
+    size = message_length(header)
+    kept = 0
+    for line in lines:
+        size += message_length(line) + 1
+        if size + reserve > MESSAGE_MAX_LENGTH:
+            break
+        kept += 1
+    text = header + "\n".join(lines[:kept])
+    if kept < total:
+        text += f"\n\n... وكمان {total - kept}"
+    return text
+
+# === Leaderboard page cache ===
+leaderboard_page_lookups = metrics.counter(
+    'mechabdol_leaderboard_page_lookups_total', 'Leaderboard pages served, by whether they were cached.', ('result',)
+)
+
+class LeaderboardPages:
+    """
+    Rendered /dash pages per group, tagged with the points version they were
+    built from. A page is rendered (names looked up, lines built) the first
+    time it's asked for and reused until a point change bumps the version;
+    while the version holds, the live ranking is the snapshot, so later pages
+    are sliced from it on demand. Least recently used groups are dropped
+    past max_groups.
+    """
+
+    def __init__(self, page_size: int, max_groups: int):
+        self.page_size = page_size
+        self.max_groups = max_groups
+        # group_id -> (version, member count, {page: lines})
+        self._groups = OrderedDict()
+
+    def _entry(self, group_id: int) -> tuple:
+        version = points_store.version(group_id)
+        entry = self._groups.get(group_id)
+        if entry is None or entry[0] != version:
+            entry = self._groups[group_id] = (version, points_store.count(group_id), {})
+            while len(self._groups) > self.max_groups:
+                self._groups.popitem(last=False)
+        self._groups.move_to_end(group_id)
+        return entry
+
+    async def page(self, context: ContextTypes.DEFAULT_TYPE, group_id: int, page: int) -> tuple:
+        """Return (version, page, page_count, lines), clamping page into range."""
+        version, count, pages = self._entry(group_id)
+        page_count = max(1, -(-count // self.page_size))
+        page = min(max(page, 0), page_count - 1)
+        lines = pages.get(page)
+        if lines is None:
+            leaderboard_page_lookups.inc('miss')
+            start = page * self.page_size
+            lines = await format_leaderboard(context, group_id, points_store.top(group_id, self.page_size, start), start)
+            pages[page] = lines
+        else:
+            leaderboard_page_lookups.inc('hit')
+        return version, page, page_count, lines
+
+leaderboard_pages = LeaderboardPages(LEADERBOARD_PAGE_SIZE, LEADERBOARD_CACHE_GROUPS)
+
+def render_dash(title: str, page: int, page_count: int, lines: list) -> str:
+    text = f"📊 قايمة المتصدرين دلوقتي 📊\nالجروب: {title}\n\n" + "\n".join(lines)
+    if page_count > 1:
+        text += f"\n\n📄 صفحة {page + 1} من {page_count} (اعرف ترتيبك بـ /rank)"
+    return text
+
+def dash_keyboard(version: int, page: int, page_count: int):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("➡️ اللي قبل", callback_data=f"dash:{page - 1}:{version}"))
+    if page < page_count - 1:
+        buttons.append(InlineKeyboardButton("اللي بعد ⬅️", callback_data=f"dash:{page + 1}:{version}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
 # === /dash command - show current leaderboard ===
+@instrumented
 async def dash_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check if command is in group
     if update.effective_chat.type == 'private':
@@ -245,40 +2750,209 @@ async def dash_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     group_id = update.effective_chat.id
-    points = load_group_points(group_id)
+    if not points_store.count(group_id):
+        outbox.send(
+            group_id,
+            "📊 مفيش نقط لسه! ابدأ إدي نقط بالرد على الرسايل بالكلمات المحددة.",
+            update.message.message_id,
+            outbox.PRIORITY_HIGH
+        )
+        return
+
+    # First page from the cache; the buttons fetch the rest
+    version, page, page_count, lines = await leaderboard_pages.page(context, group_id, 0)
+    outbox.send(
+        group_id,
+        render_dash(update.effective_chat.title, page, page_count, lines),
+        update.message.message_id,
+        outbox.PRIORITY_HIGH,
+        dash_keyboard(version, page, page_count)
+    )
+
+# === /dash page buttons ===
+@instrumented
+async def dash_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not query.message:
+        await query.answer()
+        return
+    group_id = query.message.chat.id
+    try:
+        _, requested_page, shown_version = query.data.split(':')
+        requested_page, shown_version = int(requested_page), int(shown_version)
+    except ValueError:
+        await query.answer()
+        return
+    
+    if not points_store.count(group_id):
+        await query.answer("📭 النقط اتمسحت!")
+        return
+    version, page, page_count, lines = await leaderboard_pages.page(context, group_id, requested_page)
+    # Points changed since this message was sent: the page comes from the new ranking
+    await query.answer("🔄 القايمة اتحدثت" if version != shown_version else None)
+    
+    await outbox.slot(group_id)
+    await api_limiter.acquire(group_id)
+    try:
+        await query.edit_message_text(
+            render_dash(query.message.chat.title, page, page_count, lines),
+            reply_markup=dash_keyboard(version, page, page_count)
+        )
+    except BadRequest as e:
+        # Pressing a button that leads to the page already shown
+        if 'not modified' not in str(e).lower():
+            raise
+
+# === /rank command - show a member's position and neighbours ===
+@instrumented
+async def rank_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Check if command is in group
+    if update.effective_chat.type == 'private':
+        await update.message.reply_text("⛔ الأمر ده بيشتغل في الجروبات بس!")
+        return
+    
+    group_id = update.effective_chat.id
+    # Reply to someone's message to see their rank instead of your own
+    target = update.message.from_user
+    if update.message.reply_to_message and not update.message.reply_to_message.from_user.is_bot:
+        target = update.message.reply_to_message.from_user
+    
+    rank = points_store.rank_of(group_id, target.id)
+    if rank is None:
+        outbox.send(group_id, f"📭 {target.full_name} معوش نقط لسه!", update.message.message_id, outbox.PRIORITY_HIGH)
+        return
+    
+    start = max(0, rank - RANK_NEIGHBOURS)
+    entries = points_store.top(group_id, rank - start + RANK_NEIGHBOURS + 1, start)
+    leaderboard = await format_leaderboard(context, group_id, entries, start)
+    leaderboard[rank - start] = f"👉 {leaderboard[rank - start]}"
+    
+    outbox.send(
+        group_id,
+        f"📍 ترتيب {target.full_name}: {rank + 1} من {points_store.count(group_id)}\n\n" + "\n".join(leaderboard),
+        update.message.message_id,
+        outbox.PRIORITY_HIGH
+    )
+
+# === /history command - past weekly leaderboards ===
+@instrumented
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type == 'private':
+        await update.message.reply_text("⛔ الأمر ده بيشتغل في الجروبات بس!")
+        return
+    
+    group_id = update.effective_chat.id
+    # "/history 8" shows the last 8 weeks
+    weeks = HISTORY_WEEKS_SHOWN
+    if context.args and context.args[0].isdigit():
+        weeks = max(1, min(int(context.args[0]), HISTORY_MAX_WEEKS))
+    
+    history = await asyncio.to_thread(storage.load_history, group_id, weeks)
+    if not history:
+        outbox.send(
+            group_id,
+            "📭 لسه مفيش أسابيع متسجلة! بتتسجل كل سبت مع قايمة المتصدرين.",
+            update.message.message_id,
+            outbox.PRIORITY_HIGH
+        )
+        return
+    
+    names = await get_display_names(
+        context, group_id, list({uid for _, standings in history for uid, _ in standings[:HISTORY_TOP_N]})
+    )
+    blocks = []
+    for week, standings in history:
+        block = [f"🗓️ {week} ({len(standings)} مشارك)"]
+        for idx, (uid, pts) in enumerate(standings[:HISTORY_TOP_N]):
+            medal = ("🥇", "🥈", "🥉")[idx] if idx < 3 else f"{idx + 1}."
+            block.append(f"{medal} {names.get(uid, f'يوزر {uid}')} - {pts} نقطة")
+        blocks.append("\n".join(block))
+    
+    # Show as many whole weeks as fit in one message
+    size = message_length(f"📅 قوايم آخر {len(blocks)} أسابيع:\n")
+    shown = 0
+    for block in blocks:
+        size += message_length(block) + 2
+        if size > MESSAGE_MAX_LENGTH:
+            break
+        shown += 1
+    text = f"📅 قوايم آخر {shown} أسابيع:\n\n" + "\n\n".join(blocks[:shown])
+    outbox.send(group_id, text, update.message.message_id, outbox.PRIORITY_HIGH)
+
+# === /alltime command - totals across every archived week plus this one ===
+@instrumented
+async def alltime_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.type == 'private':
+        await update.message.reply_text("⛔ الأمر ده بيشتغل في الجروبات بس!")
+        return
+    
+    group_id = update.effective_chat.id
+    totals = await asyncio.to_thread(storage.load_alltime, group_id)
+    # This week's points aren't archived yet, so add them on top
+    current = points_store.snapshot(group_id)
+    ranking = rank_standings(merge_standings(dict(totals), current.items()))
+    
+    if not ranking:
+        outbox.send(
+            group_id,
+            "📊 مفيش نقط لسه! ابدأ إدي نقط بالرد على الرسايل بالكلمات المحددة.",
+            update.message.message_id,
+            outbox.PRIORITY_HIGH
+        )
+        return
+    
+    leaderboard = await format_leaderboard(context, group_id, ranking[:LEADERBOARD_TOP_N])
+    
+    outbox.send(
+        group_id,
+        fit_leaderboard(
+            f"🏛️ قايمة المتصدرين من الأول 🏛️\nالجروب: {update.effective_chat.title}\n\n", leaderboard, len(ranking)
+        ),
+        update.message.message_id,
+        outbox.PRIORITY_HIGH
+    )
+
+# === /reset command - reset all points (admin/owner only) ===
+@instrumented
+async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Check if command is in group
+    if update.effective_chat.type == 'private':
+        await update.message.reply_text("⛔ الأمر ده بيشتغل في الجروبات بس!")
+        return
+    
+    user_id = update.message.from_user.id
+    group_id = update.effective_chat.id
     
-    if not points:
-        await update.message.reply_text("📊 مفيش نقط لسه! ابدأ إدي نقط بالرد على الرسايل بالكلمات المحددة.")
+    # Check if user is admin or owner
+    if not await is_admin_or_owner(context, group_id, user_id):
+        outbox.send(
+            group_id,
+            "⛔ لازم تكون أدمن أو صاحب الجروب علشان تمسح النقط!",
+            update.message.message_id,
+            outbox.PRIORITY_HIGH
+        )
         return
-
-    # Create leaderboard
-    sorted_points = sorted(points.items(), key=lambda x: x[1], reverse=True)
-    leaderboard = []
-    
-    for idx, (uid, pts) in enumerate(sorted_points):
-        try:
-            user = await context.bot.get_chat_member(group_id, int(uid))
-            name = user.user.full_name
-        except:
-            name = f"يوزر {uid}"
-        leaderboard.append(f"{idx+1}. {name} - {pts} نقطة")
     
-    # Add emoji indicators for top 3
-    if len(leaderboard) > 0:
-        leaderboard[0] = "🥇 " + leaderboard[0]
-    if len(leaderboard) > 1:
-        leaderboard[1] = "🥈 " + leaderboard[1]
-    if len(leaderboard) > 2:
-        leaderboard[2] = "🥉 " + leaderboard[2]
+    # Reset points for this group
+    if await group_pipeline.run(
+        group_id, reset_points, group_id, user_id, update.message.message_id, update.update_id
+    ) is REPLAYED:
+        return
     
-    await update.message.reply_text(
-        f"📊 قايمة المتصدرين دلوقتي 📊\n"
-        f"الجروب: {update.effective_chat.title}\n\n" + "\n".join(leaderboard)
+    outbox.send(
+        group_id,
+        "✅ تم مسح قايمة المتصدرين! كل النقط اتمسحت من الجروب ده.",
+        update.message.message_id,
+        outbox.PRIORITY_HIGH
+    )
+    log.info(
+        f"♻️ Points reset for group {group_id} by user {user_id}",
+        extra={'group_id': group_id, 'user_id': user_id}
     )
 
-# === /reset command - reset all points (admin/owner only) ===
-async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Check if command is in group
+# === /undo command - reverse the last point change (admin/owner only) ===
+@instrumented
+async def undo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type == 'private':
         await update.message.reply_text("⛔ الأمر ده بيشتغل في الجروبات بس!")
         return
@@ -286,57 +2960,78 @@ async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     group_id = update.effective_chat.id
     
-    # Check if user is admin or owner
     if not await is_admin_or_owner(context, group_id, user_id):
-        await update.message.reply_text("⛔ لازم تكون أدمن أو صاحب الجروب علشان تمسح النقط!")
+        outbox.send(
+            group_id,
+            "⛔ لازم تكون أدمن أو صاحب الجروب علشان تلغي آخر تعديل!",
+            update.message.message_id,
+            outbox.PRIORITY_HIGH
+        )
+        return
+    
+    result = await group_pipeline.run(
+        group_id, undo_last_action, group_id, user_id, update.message.message_id, update.update_id
+    )
+    if result is REPLAYED:
+        return
+    if result is None:
+        outbox.send(
+            group_id,
+            "🤷 مفيش تعديل نقط ينفع يتلغي (المسح والتصفير الأسبوعي مينفعش يتلغوا).",
+            update.message.message_id,
+            outbox.PRIORITY_HIGH
+        )
         return
-        
-    # Reset points for this group
-    save_group_points(group_id, {})
     
-    await update.message.reply_text("✅ تم مسح قايمة المتصدرين! كل النقط اتمسحت من الجروب ده.")
-    print(f"♻️ Points reset for group {group_id} by user {user_id}")
+    entry, totals = result
+    names = await get_display_names(context, group_id, [uid for uid, _ in entry['d']])
+    lines = ["↩️ تم إلغاء آخر تعديل:"]
+    for (uid, delta), total in zip(entry['d'], totals):
+        lines.append(f"{names.get(uid, uid)}: {-delta:+g} نقطة (المجموع: {total})")
+    outbox.send(group_id, "\n".join(lines), update.message.message_id, outbox.PRIORITY_HIGH)
+    log.info(
+        f"↩️ Undid journal entry {entry['s']} in group {group_id} for user {user_id}",
+        extra={'group_id': group_id, 'user_id': user_id}
+    )
 
 # === Save group owner and admin list ===
-async def save_group_and_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat = update.effective_chat
-    if chat.type in ['group', 'supergroup']:
-        group_id = chat.id
+@instrumented
+async def save_group_and_admins(application: Application, chat_id: int, announce_title=None):
+    """
+    Fetch the group's admins and store them if they changed. When the bot has
+    just joined, announce_title is the group's title and the bot introduces itself.
+    """
+    group_id = chat_id
+    bot = application.bot
+    
+    try:
+        # Get admins and owner
+        admins = await bot.get_chat_administrators(chat_id)
+        admin_ids = []
+        owner_id = None
         
-        try:
-            # Get admins and owner
-            admins = await context.bot.get_chat_administrators(chat.id)
-            admin_ids = []
-            owner_id = None
-            
-            for admin in admins:
-                if admin.status == 'creator':
-                    owner_id = admin.user.id
-                elif admin.status == 'administrator':
-                    admin_ids.append(admin.user.id)
-            
-            # Save owner ID
-            if owner_id:
-                owner_file = get_group_owner_file(group_id)
-                with open(owner_file, 'w') as f:
-                    f.write(str(owner_id))
-                print(f"👑 Saved group owner {owner_id} for group {group_id}")
-            
-            # Save admin IDs
-            admins_file = get_group_admins_file(group_id)
-            with open(admins_file, 'w') as f:
-                json.dump(admin_ids, f)
-            
-            # Schedule weekly job for this group
-            if context.application.job_queue:
-                schedule_leaderboard(context.application, group_id)
-            
-            print(f"✅ Saved group {group_id}: owner={owner_id}, {len(admin_ids)} admins")
-            await context.bot.send_message(
-                chat.id,
-                f"✅ البوت جاهز في الجروب: {chat.title}\n\n"
+        for admin in admins:
+            if admin.status == 'creator':
+                owner_id = admin.user.id
+            elif admin.status == 'administrator':
+                admin_ids.append(admin.user.id)
+        
+        # Save owner and admin IDs, but only when something actually changed
+        if permission_cache.set_group(group_id, owner_id, admin_ids):
+            log.info(
+                f"✅ Saved group {group_id}: owner={owner_id}, {len(admin_ids)} admins",
+                extra={'group_id': group_id}
+            )
+        
+        if announce_title is not None:
+            await bot.send_message(
+                chat_id,
+                f"✅ البوت جاهز في الجروب: {announce_title}\n\n"
                 "الأوامر:\n"
                 "/dash - عرض قايمة المتصدرين دلوقتي\n"
+                "/rank - ترتيبك وترتيب اللي حواليك\n"
+                "/history - قوايم الأسابيع اللي فاتت\n"
+                "/alltime - مجموع النقط من الأول\n"
                 "/reset - مسح النقط (الأدمنز/صاحب الجروب بس)\n\n"
                 f"الكلمات المفتاحية: {', '.join(KEYWORDS)}\n"
                 f"كلمة النقص: {', '.join(SUBTRACT_KEYWORDS)}\n\n"
@@ -346,14 +3041,64 @@ async def save_group_and_admins(update: Update, context: ContextTypes.DEFAULT_TY
                 "@username2 92\n"
                 "username3 78"
             )
-        except Exception as e:
-            print(f"❌ Error saving group data for {group_id}: {e}")
-            await context.bot.send_message(
-                chat.id,
+    except Exception as e:
+        log.error(f"❌ Error saving group data for {group_id}: {e}", extra={'group_id': group_id})
+        if announce_title is not None:
+            await bot.send_message(
+                chat_id,
                 "⚠️ مقدرش أشتغل كامل. خلي ليا صلاحيات أدمن في الجروب."
             )
 
+# === Debounced admin sync ===
+class AdminSync:
+    """
+    Coalesces admin sync requests per group: the first request opens a
+    debounce window and any others that arrive before it closes are folded
+    into the same single sync.
+    """
+
+    def __init__(self, debounce: float):
+        self.debounce = debounce
+        self._pending = {}
+        self._announce = {}
+
+    def request(self, application: Application, group_id: int, announce_title=None):
+        if announce_title is not None:
+            self._announce[group_id] = announce_title
+        if group_id not in self._pending:
+            self._pending[group_id] = asyncio.create_task(self._sync_later(application, group_id))
+
+    async def _sync_later(self, application: Application, group_id: int):
+        await asyncio.sleep(self.debounce)
+        del self._pending[group_id]
+        await save_group_and_admins(application, group_id, self._announce.pop(group_id, None))
+
+    async def stop(self):
+        for task in self._pending.values():
+            task.cancel()
+        await asyncio.gather(*self._pending.values(), return_exceptions=True)
+        self._pending.clear()
+        self._announce.clear()
+
+admin_sync = AdminSync(ADMIN_SYNC_DEBOUNCE)
+
+# === Track the bot being added to or promoted in a group ===
+@instrumented
+async def track_bot_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    change = update.my_chat_member
+    if change.chat.type not in ['group', 'supergroup']:
+        return
+    was_in_group = change.old_chat_member.status not in [ChatMember.LEFT, ChatMember.BANNED]
+    is_in_group = change.new_chat_member.status not in [ChatMember.LEFT, ChatMember.BANNED]
+    # Groups the bot has left stay registered but get no weekly leaderboard
+    group_registry.set_weekly(change.chat.id, is_in_group)
+    if is_in_group:
+        # Announce only when the bot has just been added, not on promotions
+        announce_title = None if was_in_group else (change.chat.title or "")
+        admin_sync.request(context.application, change.chat.id, announce_title)
+
 # === Handle admin/owner replies ===
+@instrumented
 async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.reply_to_message:
         return
@@ -377,52 +3122,52 @@ async def handle_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text in KEYWORDS or text in SUBTRACT_KEYWORDS:
         # Prevent self-awarding only when using keywords
         if user_id == replied_user.id:
-            await update.message.reply_text("⛔ مينفعش تدي نفسك نقط!")
+            outbox.send(group_id, "⛔ مينفعش تدي نفسك نقط!", update.message.message_id, outbox.PRIORITY_HIGH)
             return
         
         # Prevent awarding points to bots only when using keywords
         if replied_user.is_bot:
-            await update.message.reply_text("⛔ مينفعش إدي نقط للبوتات!")
+            outbox.send(group_id, "⛔ مينفعش إدي نقط للبوتات!", update.message.message_id, outbox.PRIORITY_HIGH)
             return
 
     # Check keyword for adding points
     if text in KEYWORDS:
-        replied_user_id = str(replied_user.id)
-        
-        # Load current points for this group
-        points = load_group_points(group_id)
-        points[replied_user_id] = points.get(replied_user_id, 0) + 1
-        
-        # Save updated points
-        save_group_points(group_id, points)
-        
-        # Get user's current points
-        current_points = points.get(replied_user_id, 0)
-        await update.message.reply_text(
+        totals = await group_pipeline.run(
+            group_id, award_points, group_id, [(replied_user.id, 1)], 'reply', user_id,
+            update.message.message_id, update.update_id
+        )
+        if totals is REPLAYED:
+            return
+        [current_points] = totals
+        acknowledge_points(
+            update, replied_user, 1, current_points,
             f"✅ +1 نقطة لـ {replied_user.full_name}! المجموع: {current_points} 🔥"
         )
     
     # Check keyword for subtracting points
     elif text in SUBTRACT_KEYWORDS:
-        replied_user_id = str(replied_user.id)
-        
-        # Load current points for this group
-        points = load_group_points(group_id)
-        current_points = points.get(replied_user_id, 0)
+        new_points = await group_pipeline.run(
+            group_id, subtract_point, group_id, replied_user.id, user_id,
+            update.message.message_id, update.update_id
+        )
         
-        if current_points > 0:
-            points[replied_user_id] = current_points - 1
-            save_group_points(group_id, points)
-            new_points = points[replied_user_id]
-            await update.message.reply_text(
+        if new_points is REPLAYED:
+            return
+        if new_points is not None:
+            acknowledge_points(
+                update, replied_user, -1, new_points,
                 f"❌ -1 نقطة لـ {replied_user.full_name}! المجموع: {new_points} 📉"
             )
         else:
-            await update.message.reply_text(
-                f"⚠️ {replied_user.full_name} معوش نقط أصلاً! مينفعش نشيل أكتر من كده."
+            outbox.send(
+                group_id,
+                f"⚠️ {replied_user.full_name} معوش نقط أصلاً! مينفعش نشيل أكتر من كده.",
+                update.message.message_id,
+                outbox.PRIORITY_HIGH
             )
 
 # === Handle general messages (for test scores) ===
+@instrumented
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle non-reply messages that might contain test scores."""
     if not update.message or update.message.reply_to_message:
@@ -448,14 +3193,23 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await handle_test_scores(update, context)
 
 # === Leaderboard function ===
-async def send_leaderboard(context: CallbackContext):
-    group_id = context.job.context
-    points = load_group_points(group_id)
+@instrumented
+async def send_leaderboard(context: CallbackContext, group_id: int):
+    """
+    Post one group's weekly leaderboard. The week's standings are archived
+    first, points are only cleared once the send has been confirmed, and
+    anything awarded while it was being sent carries over to next week.
+    """
+    snapshot = await group_pipeline.run(group_id, points_store.snapshot, group_id)
     
-    if not points:
-        await context.bot.send_message(group_id, "📭 مفيش حد خد نقط الأسبوع ده!")
+    if not snapshot:
+        await send_with_retry(context.bot, group_id, "📭 مفيش حد خد نقط الأسبوع ده!")
         return
 
+    # Archiving is idempotent per week, so a retried send doesn't double it
+    standings = rank_standings(snapshot)
+    await asyncio.to_thread(storage.archive_week, group_id, current_sweep_id(), standings)
+
     try:
         # Get group name
         chat = await context.bot.get_chat(group_id)
@@ -463,95 +3217,1045 @@ async def send_leaderboard(context: CallbackContext):
     except:
         group_name = f"جروب {group_id}"
 
-    sorted_points = sorted(points.items(), key=lambda x: x[1], reverse=True)
-    leaderboard = []
-    
-    for idx, (uid, pts) in enumerate(sorted_points):
-        try:
-            user = await context.bot.get_chat_member(group_id, int(uid))
-            name = user.user.full_name
-        except:
-            name = f"يوزر {uid}"
-        leaderboard.append(f"{idx+1}. {name} - {pts} نقطة")
+    # Post the archived standings: that's exactly what gets subtracted below
+    leaderboard = await format_leaderboard(context, group_id, standings[:LEADERBOARD_TOP_N])
     
-    # Add emoji indicators for top 3
-    if len(leaderboard) > 0:
-        leaderboard[0] = "🥇 " + leaderboard[0]
-    if len(leaderboard) > 1:
-        leaderboard[1] = "🥈 " + leaderboard[1]
-    if len(leaderboard) > 2:
-        leaderboard[2] = "🥉 " + leaderboard[2]
-    
-    await context.bot.send_message(
-        chat_id=group_id,
-        text=f"🏆 قايمة المتصدرين الأسبوعية 🏆\n"
-             f"الجروب: {group_name}\n\n" + "\n".join(leaderboard)
+    await send_with_retry(
+        context.bot,
+        group_id,
+        fit_leaderboard(f"🏆 قايمة المتصدرين الأسبوعية 🏆\nالجروب: {group_name}\n\n", leaderboard, len(standings))
     )
     
     # Reset points for this group
-    save_group_points(group_id, {})
-    print(f"♻️ Weekly points reset for group {group_id} after leaderboard")
+    await group_pipeline.run(group_id, carry_over_points, group_id, snapshot)
+    log.info(f"♻️ Weekly points reset for group {group_id} after leaderboard", extra={'group_id': group_id})
+
+async def send_with_retry(bot, chat_id: int, text: str, max_retries: int = 3):
+    """
+    Send a weekly message within the API rate limits, waiting out RetryAfter
+    instead of dropping it, and following a group that became a supergroup.
+    """
+    for attempt in range(max_retries + 1):
+        await outbox.slot(chat_id)
+        await api_limiter.acquire(chat_id)
+        try:
+            return await bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            if attempt == max_retries:
+                raise
+            log.warning(f"⏳ RetryAfter {e.retry_after}s while sending to {chat_id}", extra={'group_id': chat_id})
+            api_limiter.pause(e.retry_after)
+        except ChatMigrated as e:
+            if attempt == max_retries:
+                raise
+            # The old id is gone for good; the new one registers itself once it's active
+            log.info(f"🔀 Group {chat_id} moved to {e.new_chat_id}; sending there", extra={'group_id': chat_id})
+            group_registry.set_weekly(chat_id, False)
+            chat_id = e.new_chat_id
+
+# === Weekly leaderboard sweep ===
+class SweepCheckpoint:
+    """
+    Append-only record of the groups the current sweep has finished: a JSON
+    header naming the sweep, then one group id per line. A restart reads it
+    back and skips those groups.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = None
+
+    def load(self):
+        """Return (sweep_id, finished, done_group_ids) from the last sweep, or (None, True, set())."""
+        try:
+            with open(self.path, 'r') as f:
+                header = json.loads(f.readline())
+                done = set()
+                for line in f:
+                    line = line.strip()
+                    if line == 'finished':
+                        return header['sweep_id'], True, done
+                    if line:
+                        done.add(int(line))
+                return header['sweep_id'], False, done
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, ValueError):
+            return None, True, set()
+
+    def open(self, sweep_id: str, resume: bool):
+        if resume:
+            self._file = open(self.path, 'a')
+        else:
+            atomic_write_text(self.path, json.dumps({'sweep_id': sweep_id}) + "\n")
+            self._file = open(self.path, 'a')
+
+    def mark_done(self, group_ids: list):
+        self._file.write("".join(f"{group_id}\n" for group_id in group_ids))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+        self._file = None
+
+    def finish(self):
+        self._file.write("finished\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+def sweep_checkpoint_path(shard_index: int) -> Path:
+    if shard_index < 0:
+        return Path(DATA_DIR) / 'leaderboard_sweep.log'
+    return SHARD_DIR / f'leaderboard_sweep.shard-{shard_index}.log'
+
+sweep_checkpoint = SweepCheckpoint(sweep_checkpoint_path(SHARD_INDEX))
+
+def current_sweep_id() -> str:
+    # One sweep per ISO week
+    return datetime.datetime.now(pytz.UTC).strftime('%G-W%V')
+
+@instrumented
+async def leaderboard_sweep(context: CallbackContext):
+    """
+    Send every registered group its weekly leaderboard from a single job,
+    spread over LEADERBOARD_SWEEP_WINDOW seconds with at most
+    LEADERBOARD_SWEEP_CONCURRENCY groups in flight. Finished groups are
+    checkpointed (after their reset has been flushed) so a restart resumes;
+    failed groups are retried with backoff, and if any are left the sweep
+    stays unfinished and a resume is scheduled.
+    """
+    sweep_id = current_sweep_id()
+    resuming = context.job.data if context.job else None
+    if resuming and resuming != sweep_id:
+        # A resume that outlived its week; the new week's sweep covers these groups
+        log.warning(f"⚠️ Dropping resume of leaderboard sweep {resuming}, now in {sweep_id}", extra={'sweep_id': resuming})
+        return
+    last_id, finished, done = sweep_checkpoint.load()
+    resume = last_id == sweep_id
+    if resume and finished:
+        log.info(f"✅ Leaderboard sweep {sweep_id} already finished", extra={'sweep_id': sweep_id})
+        return
+    if not resume:
+        done = set()
+    sweep_checkpoint.open(sweep_id, resume)
+
+    group_ids = sorted(group_registry.weekly_groups() - done)
+    log.info(
+        f"🏁 Leaderboard sweep {sweep_id}: {len(group_ids)} groups to send ({len(done)} already done)",
+        extra={'sweep_id': sweep_id}
+    )
+
+    # Every shard sweeps its own groups at the same time
+    semaphore = asyncio.Semaphore(max(1, LEADERBOARD_SWEEP_CONCURRENCY // SHARDS))
+    completed = []
+    failed = []
+
+    async def checkpoint():
+        # Make the resets durable before recording the groups as done
+        batch = completed[:]
+        if not batch:
+            return
+        if not await points_store.flush():
+            # Left in completed: the next checkpoint tries again
+            return
+        del completed[:len(batch)]
+        await asyncio.to_thread(sweep_checkpoint.mark_done, batch)
+
+    async def send_one(group_id: int):
+        try:
+            await send_leaderboard(context, group_id)
+            completed.append(group_id)
+        except Forbidden:
+            # The bot was removed from the group; nothing to retry
+            log.info(f"🚪 Skipping group {group_id}: bot is no longer a member", extra={'group_id': group_id})
+            group_registry.set_weekly(group_id, False)
+            completed.append(group_id)
+        except BadRequest as e:
+            if 'chat not found' not in str(e).lower():
+                log.error(f"❌ Error sending weekly leaderboard to {group_id}: {e}", extra={'group_id': group_id})
+                failed.append(group_id)
+                return
+            # Deleted, or an old id whose migration we never saw; retrying can't help
+            log.info(f"🚪 Skipping group {group_id}: chat no longer exists", extra={'group_id': group_id})
+            group_registry.set_weekly(group_id, False)
+            completed.append(group_id)
+        except Exception as e:
+            log.error(f"❌ Error sending weekly leaderboard to {group_id}: {e}", extra={'group_id': group_id})
+            failed.append(group_id)
+        finally:
+            semaphore.release()
+
+    async def send_batch(batch: list, window: float):
+        nonlocal last_checkpoint
+        batch_started = time.monotonic()
+        tasks = set()
+        for index, group_id in enumerate(batch):
+            # Stagger the start times evenly across the window
+            delay = batch_started + index * window / len(batch) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await semaphore.acquire()
+            task = asyncio.create_task(send_one(group_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            if time.monotonic() - last_checkpoint >= SWEEP_CHECKPOINT_INTERVAL:
+                await checkpoint()
+                last_checkpoint = time.monotonic()
+        await asyncio.gather(*tasks)
+        await checkpoint()
+
+    started = time.monotonic()
+    last_checkpoint = started
+    await send_batch(group_ids, LEADERBOARD_SWEEP_WINDOW)
+
+    for attempt in range(LEADERBOARD_SWEEP_RETRIES):
+        if not failed:
+            break
+        retry = failed[:]
+        failed.clear()
+        delay = LEADERBOARD_SWEEP_RETRY_DELAY * 2 ** attempt
+        log.warning(
+            f"🔁 Leaderboard sweep {sweep_id}: retrying {len(retry)} failed groups in {delay:.0f}s",
+            extra={'sweep_id': sweep_id}
+        )
+        await asyncio.sleep(delay)
+        await send_batch(retry, 0)
+
+    if failed or completed:
+        # Not all groups are sent and durable; the resume picks up the rest
+        await asyncio.to_thread(sweep_checkpoint.close)
+        delay = LEADERBOARD_SWEEP_RETRY_DELAY * 2 ** LEADERBOARD_SWEEP_RETRIES
+        log.error(
+            f"❌ Leaderboard sweep {sweep_id} left unfinished: {len(failed)} failed, "
+            f"{len(completed)} not flushed; resuming in {delay:.0f}s",
+            extra={'sweep_id': sweep_id}
+        )
+        context.job_queue.run_once(leaderboard_sweep, when=delay, data=sweep_id, name="weekly_leaderboard_sweep_resume")
+        return
+
+    await asyncio.to_thread(sweep_checkpoint.finish)
+    log.info(
+        f"🏆 Leaderboard sweep {sweep_id} finished in {time.monotonic() - started:.0f}s",
+        extra={'sweep_id': sweep_id}
+    )
 
 # === Schedule leaderboard ===
-def schedule_leaderboard(application: Application, group_id: int):
+def track_job_lag(scheduler):
+    """Record how late each job is handed to the executor, by job name."""
+    from apscheduler.events import EVENT_JOB_ADDED, EVENT_JOB_SUBMITTED
+
+    # One-off jobs are already gone from the scheduler when their submission
+    # event fires, so remember names as jobs are added
+    names = {}
+
+    def on_event(event):
+        if event.code == EVENT_JOB_ADDED:
+            job = scheduler.get_job(event.job_id)
+            if job:
+                names[event.job_id] = job.name
+            return
+        job = scheduler.get_job(event.job_id)
+        name = job.name if job else names.pop(event.job_id, 'unknown')
+        now = datetime.datetime.now(pytz.UTC)
+        for scheduled in event.scheduled_run_times:
+            job_lag_seconds.observe(max(0.0, (now - scheduled).total_seconds()), name)
+
+    scheduler.add_listener(on_event, EVENT_JOB_ADDED | EVENT_JOB_SUBMITTED)
+
+def schedule_leaderboard(application: Application):
     if not application.job_queue:
+        log.warning("⚠️ No JobQueue available (install python-telegram-bot[job-queue]); weekly leaderboards are off")
         return
     
-    # Remove existing jobs for this group
-    job_name = f"weekly_leaderboard_{group_id}"
-    current_jobs = application.job_queue.get_jobs_by_name(job_name)
-    for job in current_jobs:
-        job.schedule_removal()
+    track_job_lag(application.job_queue.scheduler)
     
-    # Schedule new job (Saturday 6 AM UTC)
+    # One job for every group (Saturday 6 AM UTC)
     application.job_queue.run_daily(
-        send_leaderboard,
+        leaderboard_sweep,
         time=datetime.time(hour=6, minute=0, tzinfo=pytz.UTC),
-        days=(5,),  # Saturday (0=Monday, 6=Sunday)
-        context=group_id,
-        name=job_name
+        days=(6,),  # Saturday (0=Sunday, 6=Saturday)
+        name="weekly_leaderboard_sweep"
     )
-    print(f"⏰ Scheduled weekly leaderboard for group {group_id} on Saturdays at 06:00 UTC")
+    log.info("⏰ Scheduled weekly leaderboard sweep on Saturdays at 06:00 UTC")
+    
+    # Pick up a sweep that a restart interrupted
+    sweep_id, finished, done = sweep_checkpoint.load()
+    if sweep_id == current_sweep_id() and not finished:
+        log.info(
+            f"🔁 Resuming leaderboard sweep {sweep_id} ({len(done)} groups already done)",
+            extra={'sweep_id': sweep_id}
+        )
+        application.job_queue.run_once(
+            leaderboard_sweep, when=0, data=sweep_id, name="weekly_leaderboard_sweep_resume"
+        )
 
 # === Load and schedule existing groups ===
 def load_existing_groups(application: Application):
-    if not GROUPS_DATA_DIR.exists():
-        return
-    
-    # Find all group data files
-    group_ids = set()
-    for file in GROUPS_DATA_DIR.iterdir():
-        if file.name.startswith('points_') and file.name.endswith('.json'):
-            try:
-                group_id = int(file.name.replace('points_', '').replace('.json', ''))
-                group_ids.add(group_id)
-            except ValueError:
-                continue
+    # Only the registry is read here; each group's data loads on its first update
+    log.info(f"🔍 Found {group_registry.load()} existing groups")
     
-    # Schedule leaderboards for existing groups
-    for group_id in group_ids:
-        schedule_leaderboard(application, group_id)
-        print(f"🔍 Found and scheduled existing group: {group_id}")
+    schedule_leaderboard(application)
 
-# === Main bot function ===
-def main():
-    application = Application.builder().token(TOKEN).build()
+# === Minimal HTTP server (webhook, health) ===
+class HttpServer:
+    """
+    A small HTTP/1.1 server on asyncio streams, just enough for the webhook
+    and health endpoints without pulling in a web framework. One request per
+    connection; handlers return (status, content_type, body).
+    """
+
+    MAX_BODY = 1024 * 1024
+    REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error',
+               503: 'Service Unavailable'}
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes = {}
+        self._server = None
+
+    def route(self, method: str, path: str, handler):
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        log.info(f"🌐 HTTP server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            status, content_type, body = await self._dispatch(reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            status, content_type, body = 400, 'text/plain', b'bad request'
+        except Exception as e:
+            log.error(f"❌ Error handling HTTP request: {e}")
+            status, content_type, body = 500, 'text/plain', b'internal error'
+        try:
+            writer.write(
+                f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, reader: asyncio.StreamReader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            raise ValueError("malformed request line")
+        method, target, _ = request_line
+        path = target.split('?', 1)[0]
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0))
+        if length > self.MAX_BODY:
+            return 413, 'text/plain', b'payload too large'
+        body = await reader.readexactly(length) if length else b''
+
+        handler = self._routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for _, route_path in self._routes):
+                return 405, 'text/plain', b'method not allowed'
+            return 404, 'text/plain', b'not found'
+        return await handler(headers, body)
+
+# Shard workers serve their own /metrics on loopback, next to the dispatcher's PORT
+http_server = HttpServer('127.0.0.1', PORT + 1 + SHARD_INDEX) if SHARD_INDEX >= 0 else HttpServer('0.0.0.0', PORT)
+
+def add_http_routes(application: Application, webhook: bool):
+    async def health(headers: dict, body: bytes):
+        # Liveness: the process is up and serving HTTP
+        return 200, 'text/plain', b'ok'
+
+    async def ready(headers: dict, body: bytes):
+        # Readiness: the Application has started and is taking updates
+        if application.running:
+            return 200, 'text/plain', b'ready'
+        return 503, 'text/plain', b'starting'
+
+    async def telegram_webhook(headers: dict, body: bytes):
+        if not webhook_authorized(headers):
+            return 403, 'text/plain', b'forbidden'
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            return 400, 'text/plain', b'invalid update'
+        if not isinstance(data, dict):
+            return 400, 'text/plain', b'invalid update'
+        try:
+            update = Update.de_json(data, application.bot)
+        except (TypeError, KeyError):
+            return 400, 'text/plain', b'invalid update'
+        await application.update_queue.put(update)
+        return 200, 'text/plain', b'ok'
+
+    async def prometheus_metrics(headers: dict, body: bytes):
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode()
+
+    http_server.route('GET', '/health', health)
+    http_server.route('GET', '/ready', ready)
+    http_server.route('GET', '/metrics', prometheus_metrics)
+    if webhook:
+        http_server.route('POST', WEBHOOK_PATH, telegram_webhook)
+
+# === Runtime gauges for /metrics ===
+metrics.gauge('mechabdol_points_pending_changes', 'Point changes not yet flushed to storage.', lambda: points_store._pending)
+metrics.gauge('mechabdol_points_resident_bytes', 'Estimated memory held by resident group points.', lambda: points_store.resident_bytes)
+metrics.gauge(
+    'mechabdol_group_state_resident_bytes', 'Estimated memory held by resident points, usernames and admin lists.',
+    lambda: points_store.total_resident_bytes
+)
+metrics.gauge('mechabdol_points_resident_groups', 'Groups whose points are resident.', points_store.resident_groups)
+metrics.gauge('mechabdol_journal_bytes', 'Size of the points journal on disk.', lambda: points_journal.size)
+metrics.gauge('mechabdol_outbox_queued', 'Replies waiting in the outbox.', outbox.queued)
+metrics.gauge('mechabdol_group_workers', 'Active per-group pipeline workers.', lambda: len(group_pipeline._workers))
+metrics.gauge('mechabdol_registered_groups', 'Groups in the group registry.', lambda: len(group_registry))
+
+# === Application lifecycle hooks ===
+async def post_init(application: Application):
+    event_loop_probe.start()
+    outbox.start(application.bot)
+    points_store.recover()
+    # A crash may have lost the registry entries of groups the journal knows
+    for group_id in points_store._groups:
+        group_registry.touch(group_id)
+    points_journal.start()
+    points_store.start()
+    username_index.start()
+    group_registry.start()
+    await http_server.start()
+
+async def post_init_with_catch_up(application: Application):
+    await post_init(application)
+    await catch_up_backlog(application)
+
+async def post_stop(application: Application):
+    await http_server.stop()
+    catch_up_summary.flush()
+    await outbox.stop()
+    await admin_sync.stop()
+    await group_pipeline.stop()
+    await points_store.stop()
+    await points_journal.stop()
+    await username_index.stop()
+    await group_registry.stop()
+    await event_loop_probe.stop()
+
+# === Build the bot application ===
+def build_application(**builder_options) -> Application:
+    # Time every Bot API call, whichever transport is in use
+    builder_options['request'] = InstrumentedRequest(
+        builder_options.get('request') or HTTPXRequest(connection_pool_size=256)
+    )
+    builder_options['get_updates_request'] = InstrumentedRequest(
+        builder_options.get('get_updates_request') or HTTPXRequest()
+    )
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES or False)
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    for option, value in builder_options.items():
+        builder = getattr(builder, option)(value)
+    application = builder.build()
     
     # Add handlers
+    # Record member names from every update before the real handlers run
+    application.add_handler(TypeHandler(Update, remember_users), group=-1)
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("dash", dash_command))
+    application.add_handler(CallbackQueryHandler(dash_page_callback, pattern=r'^dash:'))
+    application.add_handler(CommandHandler("rank", rank_command))
+    application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("alltime", alltime_command))
     application.add_handler(CommandHandler("reset", reset_command))
-    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, save_group_and_admins))
+    application.add_handler(CommandHandler("undo", undo_command))
+    application.add_handler(ChatMemberHandler(track_bot_membership, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(MessageHandler(filters.TEXT & filters.REPLY, handle_reply))
     # Add handler for multi-line messages (test scores) with lower priority
     application.add_handler(MessageHandler(filters.TEXT & ~filters.REPLY & ~filters.COMMAND, handle_message))
+    return application
+
+# === Running the Application by hand ===
+async def wait_for_signal():
+    """Return once SIGINT or SIGTERM arrives."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def run_until_signalled(application: Application, on_started=None, on_stopping=None):
+    """
+    Mirror the lifecycle run_polling goes through, including the hooks, for
+    modes where updates arrive some other way. on_started runs once the
+    Application is up and on_stopping before it is stopped.
+    """
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        if on_started:
+            await on_started()
+        await wait_for_signal()
+    finally:
+        if on_stopping:
+            await on_stopping()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# === Webhook mode ===
+def ensure_webhook_secret():
+    """Never serve webhook updates unauthenticated: generate a secret for the webhook we register, or refuse to start."""
+    global WEBHOOK_SECRET
+    if WEBHOOK_SECRET:
+        return
+    if not WEBHOOK_URL:
+        # Whoever POSTs the updates has to know the secret, so it can't be made up here
+        log.error("❌ Webhook mode needs WEBHOOK_SECRET when WEBHOOK_URL isn't set")
+        sys.exit(1)
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+    log.info("🔑 WEBHOOK_SECRET not set; registering the webhook with a generated one")
+
+def webhook_authorized(headers: dict) -> bool:
+    token = headers.get('x-telegram-bot-api-secret-token', '')
+    return hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode())
+
+async def register_webhook(bot: Bot):
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+        log.info(f"🔗 Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    else:
+        log.info(f"🔗 WEBHOOK_URL not set; accepting updates POSTed to {WEBHOOK_PATH} without registering a webhook")
+
+async def run_webhook(application: Application):
+    """Serve updates from Telegram's webhook on PORT instead of long polling."""
+    await run_until_signalled(application, lambda: register_webhook(application.bot))
+
+# === Sharding ===
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+class HashRing:
+    """
+    Consistent-hash ring with SHARD_VNODES points per shard, so changing the
+    shard count only moves about 1/N of the groups to a new owner.
+    """
+
+    def __init__(self, shards: int, vnodes: int):
+        points = sorted(
+            (ring_hash(f'shard-{shard}-{vnode}'), shard) for shard in range(shards) for vnode in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def owner(self, key: int) -> int:
+        index = bisect.bisect(self._hashes, ring_hash(str(key))) % len(self._hashes)
+        return self._shards[index]
+
+shard_ring = HashRing(SHARDS, SHARD_VNODES)
+
+def owns_group(group_id: int) -> bool:
+    """Whether this process is responsible for a group (always, unless it's a shard worker)."""
+    return SHARD_INDEX < 0 or shard_ring.owner(group_id) == SHARD_INDEX
+
+def update_chat_id(data: dict) -> int:
+    """The chat a raw update belongs to; updates without one go by the sender."""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'my_chat_member', 'chat_member', 'chat_join_request'):
+        if key in data:
+            return data[key]['chat']['id']
+    callback_query = data.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user')
+            if sender:
+                return sender['id']
+    return 0
+
+def shard_socket_path(shard_index: int) -> Path:
+    return SHARD_DIR / f'shard-{shard_index}.sock'
+
+dispatched_updates = metrics.counter(
+    'mechabdol_dispatched_updates_total', 'Updates forwarded to each shard.', ('shard',)
+)
+rejected_updates = metrics.counter(
+    'mechabdol_dispatch_rejected_total', 'Updates turned away because their shard\'s queue was full.', ('shard',)
+)
+
+async def fold_journal(directory: Path) -> bool:
+    """Replay a journal directory into the snapshots and delete its segments; False if that failed."""
+    journal = PointsJournal(directory, JOURNAL_SYNC_INTERVAL)
+    store = PointsStore(POINTS_FLUSH_INTERVAL, POINTS_FLUSH_MAX_PENDING, journal)
+    store.recover()
+    folded = await store.compact()
+    await journal.stop()
+    if folded:
+        for _, path in journal._segments():
+            path.unlink()
+    return folded
+
+def hand_over_sweep(shards: int):
+    """
+    Rewrite the leaderboard sweep checkpoints for a new shard layout. Every
+    new shard gets the union of the groups done this week; each only ever
+    sends the groups it owns, so nothing is sent twice or skipped.
+    """
+    old_paths = [sweep_checkpoint_path(-1)] + sorted(SHARD_DIR.glob('leaderboard_sweep.shard-*.log'))
+    sweep_id = current_sweep_id()
+    done = set()
+    seen = False
+    unfinished = False
+    for path in old_paths:
+        last_id, finished, groups = SweepCheckpoint(path).load()
+        if last_id == sweep_id:
+            seen = True
+            done |= groups
+            unfinished = unfinished or not finished
+        path.unlink(missing_ok=True)
+    if not seen:
+        return
+    for index in (range(shards) if shards > 1 else [-1]):
+        checkpoint = SweepCheckpoint(sweep_checkpoint_path(index))
+        checkpoint.open(sweep_id, resume=False)
+        checkpoint.mark_done(sorted(done))
+        if unfinished:
+            checkpoint.close()
+        else:
+            checkpoint.finish()
+    log.info(f"🔀 Handed leaderboard sweep {sweep_id} over to {shards} shard(s), {len(done)} groups already done")
+
+def hand_over_registry(shards: int):
+    """Split the JSON group registry files along the new shard layout."""
+    old_paths = [get_registry_file(-1)] + sorted(SHARD_DIR.glob('groups_registry.shard-*.json'))
+    groups = {}
+    for path in old_paths:
+        try:
+            data = json.loads(path.read_text())['groups']
+        except FileNotFoundError:
+            continue
+        except (json.JSONDecodeError, KeyError):
+            # Lost entries are rebuilt from storage or re-registered on the next update
+            log.warning(f"⚠️ Ignoring damaged group registry {path}")
+            data = {}
+        for group_id, entry in data.items():
+            if group_id not in groups or entry[0] > groups[group_id][0]:
+                groups[group_id] = entry
+    if not groups:
+        return
+    ring = HashRing(shards, SHARD_VNODES)
+    split = {index: {} for index in (range(shards) if shards > 1 else [-1])}
+    for group_id, entry in groups.items():
+        split[ring.owner(int(group_id)) if shards > 1 else -1][group_id] = entry
+    for index, entries in split.items():
+        atomic_write_text(get_registry_file(index), json.dumps({'groups': entries}, separators=(',', ':')))
+    for path in old_paths:
+        if path not in {get_registry_file(index) for index in split}:
+            path.unlink(missing_ok=True)
+
+def prepare_shards(shards: int):
+    """
+    Run before any worker starts, in sharded and single-process mode alike:
+    fold every journal left behind by an earlier run into the snapshots, and
+    if the shard count changed, carry an in-progress sweep over to the new
+    layout. After this, group ownership can move freely between shards.
+    """
+    SHARD_DIR.mkdir(parents=True, exist_ok=True)
+
+    async def fold_all():
+        for directory in [JOURNAL_DIR] + sorted(JOURNAL_DIR.glob('shard-*')):
+            if not any(directory.glob('points.*.log')):
+                continue
+            if not await fold_journal(directory):
+                raise RuntimeError(f"could not fold the points journal in {directory}")
+            log.info(f"📜 Folded leftover journal {directory} into the points snapshots")
+            if directory != JOURNAL_DIR:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    # Not asyncio.run(): that leaves the main thread without an event loop,
+    # which run_polling still expects to find
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(fold_all())
+    finally:
+        loop.close()
+
+    layout_file = SHARD_DIR / 'layout.json'
+    try:
+        previous = json.loads(layout_file.read_text())['shards']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        previous = 1
+    if previous != shards:
+        log.info(f"🔀 Shard count changed from {previous} to {shards}")
+        hand_over_sweep(shards)
+        hand_over_registry(shards)
+        atomic_write_text(layout_file, json.dumps({'shards': shards}))
+
+class ShardSupervisor:
+    """Starts one worker process per shard and restarts any that exit unexpectedly."""
+
+    def __init__(self, shards: int):
+        self.shards = shards
+        self._processes = {}
+        self._tasks = []
+        self._stopping = False
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._keep_running(index)) for index in range(self.shards)]
+
+    async def _keep_running(self, index: int):
+        backoff = 1
+        while not self._stopping:
+            shard_socket_path(index).unlink(missing_ok=True)
+            env = dict(os.environ, SHARDS=str(self.shards), SHARD_INDEX=str(index))
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), 'shard', env=env
+            )
+            self._processes[index] = process
+            started = time.monotonic()
+            code = await process.wait()
+            if self._stopping:
+                return
+            log.error(f"❌ Shard {index} exited with code {code}; restarting in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = 1 if time.monotonic() - started > 60 else min(backoff * 2, 60)
+
+    async def stop(self, timeout: float = 30):
+        """Ask every worker to shut down cleanly, killing any that take longer than timeout."""
+        self._stopping = True
+        running = [process for process in self._processes.values() if process.returncode is None]
+        for process in running:
+            process.send_signal(signal.SIGTERM)
+        if running:
+            _, still_running = await asyncio.wait(
+                [asyncio.create_task(process.wait()) for process in running], timeout=timeout
+            )
+            if still_running:
+                log.warning(f"⚠️ Killing {len(still_running)} shard(s) that didn't stop within {timeout}s")
+                for process in running:
+                    if process.returncode is None:
+                        process.kill()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+class ShardRouter:
+    """
+    Forwards raw update JSON to the owning shard's socket, reconnecting as
+    workers restart. Each shard has its own queue and sender, so a shard
+    that is down only holds back its own updates: they wait until it's back,
+    and only a full queue turns new ones away.
+    """
+
+    def __init__(self, shards: int, ring: HashRing, queue_size: int):
+        self.shards = shards
+        self.ring = ring
+        self._writers = {}
+        self._queues = {shard: asyncio.Queue(queue_size) for shard in range(shards)}
+        self._senders = []
+        # update_ids accepted but not yet written to their shard
+        self.undelivered = set()
+
+    async def _writer(self, shard: int) -> asyncio.StreamWriter:
+        writer = self._writers.get(shard)
+        if writer is None or writer.is_closing():
+            _, writer = await asyncio.open_unix_connection(str(shard_socket_path(shard)))
+            self._writers[shard] = writer
+        return writer
+
+    @property
+    def connected(self) -> bool:
+        return all(
+            shard in self._writers and not self._writers[shard].is_closing() for shard in range(self.shards)
+        )
+
+    async def connect_all(self):
+        """Wait a while for every worker's socket to come up, then start the senders."""
+        async def connect(shard: int):
+            for attempt in range(SHARD_CONNECT_RETRIES):
+                if await self._send(shard, b''):
+                    return
+                await asyncio.sleep(min(5.0, 0.2 * 2 ** attempt))
+
+        await asyncio.gather(*(connect(shard) for shard in range(self.shards)))
+        self._senders = [asyncio.create_task(self._sender(shard)) for shard in range(self.shards)]
+
+    def route(self, data: dict) -> bool:
+        """Queue an update for the shard that owns its chat; False if that shard's queue is full."""
+        shard = self.ring.owner(update_chat_id(data))
+        line = (json.dumps(data, ensure_ascii=False, separators=(',', ':')) + "\n").encode()
+        try:
+            self._queues[shard].put_nowait((data.get('update_id'), line))
+        except asyncio.QueueFull:
+            rejected_updates.inc(str(shard))
+            return False
+        self.undelivered.add(data.get('update_id'))
+        return True
+
+    async def _sender(self, shard: int):
+        queue = self._queues[shard]
+        while True:
+            update_id, line = await queue.get()
+            attempt = 0
+            while not await self._send(shard, line):
+                if attempt == 0:
+                    log.warning(f"⚠️ Shard {shard} is unreachable; holding its {queue.qsize() + 1} queued updates")
+                await asyncio.sleep(min(5.0, 0.2 * 2 ** attempt))
+                attempt += 1
+            self.undelivered.discard(update_id)
+            dispatched_updates.inc(str(shard))
+            queue.task_done()
+
+    async def _send(self, shard: int, line: bytes) -> bool:
+        try:
+            writer = await self._writer(shard)
+            if line:
+                writer.write(line)
+                await writer.drain()
+            return True
+        except OSError:
+            self._writers.pop(shard, None)
+            return False
+
+    async def drain(self, timeout: float = 10):
+        """Give queued updates up to timeout seconds to reach their shards."""
+        if not self._senders:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues.values())), timeout)
+        except asyncio.TimeoutError:
+            log.error(f"❌ {len(self.undelivered)} updates still queued for unreachable shards")
+
+    async def close(self):
+        await self.drain()
+        for task in self._senders:
+            task.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        self._senders = []
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+async def run_shard(application: Application):
+    """
+    Shard worker: take the updates for the groups this shard owns from the
+    dispatcher over a unix socket, one JSON update per line.
+    """
+    server = None
+    connections = set()
+
+    async def receive(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connections.add(writer)
+        try:
+            while line := await reader.readline():
+                try:
+                    update = Update.de_json(json.loads(line), application.bot)
+                except (json.JSONDecodeError, TypeError, KeyError):
+                    log.warning("⚠️ Dropping a malformed update from the dispatcher")
+                    continue
+                await application.update_queue.put(update)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            connections.discard(writer)
+            writer.close()
+
+    async def listen():
+        nonlocal server
+        socket_path = shard_socket_path(SHARD_INDEX)
+        socket_path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(receive, path=str(socket_path), limit=SHARD_MAX_UPDATE_BYTES)
+        log.info(f"🧩 Shard {SHARD_INDEX} of {SHARDS} listening on {socket_path}")
+
+    async def stop_listening():
+        # Take no more updates; the ones already queued are still processed
+        if server:
+            server.close()
+        for writer in list(connections):
+            writer.close()
+        await asyncio.sleep(0)
+
+    await run_until_signalled(application, listen, stop_listening)
+
+async def poll_updates(bot: Bot, router: ShardRouter):
+    """
+    Long-poll Telegram and route every update; cancel to stop. The offset
+    never moves past an update that couldn't be queued, so Telegram hands
+    it out again; updates behind it that were queued aren't routed twice.
+    """
+    await bot.delete_webhook()
+    offset = None
+    routed = set()
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramError as e:
+                log.warning(f"⚠️ Polling failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            held = False
+            for update in updates:
+                if update.update_id not in routed:
+                    if not router.route(update.to_dict()):
+                        held = True
+                        continue
+                    routed.add(update.update_id)
+                if not held:
+                    offset = update.update_id + 1
+            if offset is not None:
+                routed = {update_id for update_id in routed if update_id >= offset}
+            if held:
+                # A shard's queue is full; give it a moment to drain
+                await asyncio.sleep(1)
+    finally:
+        if offset is not None:
+            # Confirm only what reached the shards, so a restart sees the rest again
+            await router.drain()
+            if router.undelivered:
+                offset = min(offset, min(router.undelivered))
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+
+async def run_dispatcher(webhook: bool):
+    """
+    Front process for sharded mode: start the workers, then receive updates
+    by polling or webhook and forward each to the shard that owns its chat.
+    """
+    supervisor = ShardSupervisor(SHARDS)
+    router = ShardRouter(SHARDS, shard_ring, SHARD_QUEUE_SIZE)
+    bot = Bot(
+        TOKEN,
+        request=InstrumentedRequest(HTTPXRequest()),
+        get_updates_request=InstrumentedRequest(HTTPXRequest())
+    )
+
+    async def health(headers: dict, body: bytes):
+        return 200, 'text/plain', b'ok'
+
+    async def ready(headers: dict, body: bytes):
+        if router.connected:
+            return 200, 'text/plain', b'ready'
+        return 503, 'text/plain', b'waiting for shards'
+
+    async def prometheus_metrics(headers: dict, body: bytes):
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode()
+
+    async def telegram_webhook(headers: dict, body: bytes):
+        if not webhook_authorized(headers):
+            return 403, 'text/plain', b'forbidden'
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            return 400, 'text/plain', b'invalid update'
+        if not isinstance(data, dict):
+            return 400, 'text/plain', b'invalid update'
+        if not router.route(data):
+            # Telegram retries a failed delivery later
+            return 503, 'text/plain', b'shard busy'
+        return 200, 'text/plain', b'ok'
+
+    http_server.route('GET', '/health', health)
+    http_server.route('GET', '/ready', ready)
+    http_server.route('GET', '/metrics', prometheus_metrics)
+    if webhook:
+        http_server.route('POST', WEBHOOK_PATH, telegram_webhook)
+
+    supervisor.start()
+    await http_server.start()
+    poller = None
+    try:
+        await router.connect_all()
+        log.info(f"🧩 Dispatching to {SHARDS} shards ({'webhook' if webhook else 'polling'})")
+        async with bot:
+            if webhook:
+                await register_webhook(bot)
+            else:
+                poller = asyncio.create_task(poll_updates(bot, router))
+            await wait_for_signal()
+            if poller:
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+    finally:
+        await http_server.stop()
+        await router.close()
+        await supervisor.stop()
+
+# === Main bot function ===
+def main():
+    webhook = BOT_MODE == 'webhook'
+    if webhook:
+        ensure_webhook_secret()
+    prepare_shards(SHARDS)
+    if SHARDS > 1:
+        log.info("🤖 البوت شغال دلوقتي...")
+        asyncio.run(run_dispatcher(webhook))
+        return
+    
+    application = build_application()
+    add_http_routes(application, webhook)
     
     # Load existing groups and schedule jobs
     load_existing_groups(application)
     
     # Start the bot
-    print("🤖 البوت شغال دلوقتي...")
-    application.run_polling()
+    log.info("🤖 البوت شغال دلوقتي...")
+    if webhook:
+        asyncio.run(run_webhook(application))
+    else:
+        # Replay the backlog by chat before polling takes over; chat_member
+        # updates are only delivered when asked for explicitly
+        application.post_init = post_init_with_catch_up
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def run_shard_worker():
+    # Started by the dispatcher with SHARD_INDEX set; updates come over the socket
+    application = build_application(updater=None)
+    add_http_routes(application, webhook=False)
+    load_existing_groups(application)
+    asyncio.run(run_shard(application))
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['migrate']:
+        # One-shot re-import of groups_data/*.json into the SQLite database
+        migrate_json_to_sqlite(storage if storage.name == 'sqlite' else SqliteStorage(SQLITE_PATH), force=True)
+    elif sys.argv[1:] == ['shard'] and SHARD_INDEX >= 0:
+        run_shard_worker()
+    else:
+        main()
@@ -0,0 +1,348 @@
+"""
+Throughput benchmark for the update handlers.
+
+Drives the real Application built by abdol.build_application with a
+synthetic stream of group updates: keyword replies (+1 / حذف), multi-line
+test-score messages, /dash, /rank and plain chatter. Bot API calls go to a
+local stub that adds latency and answers a fraction of sendMessage calls with
+a 429 RetryAfter. After the stream, every group's weekly leaderboard is sent.
+
+Reports updates/sec, p50/p99 handler latency per update kind, Bot API calls
+and file/SQL I/O per update. With --json the results are printed as one JSON
+object so runs on different commits can be diffed.
+
+    python benchmarks/bench_handlers.py [--groups 20] [--members 50] [--updates 5000]
+        [--mix award=60,subtract=5,test=5,dash=5,rank=5,chatter=20] [--test-lines 20]
+        [--api-latency 20] [--retry-after-rate 0.005] [--backend json|sqlite] [--json]
+
+Telegram's own rate limits are lifted so the numbers measure the bot, not
+the throttle; pass --real-limits to keep them.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import CallbackContext  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+abdol = None
+
+DEFAULT_MIX = 'award=60,subtract=5,test=5,dash=5,rank=5,chatter=20'
+
+class StubBotApi(BaseRequest):
+    """Answers Bot API calls locally after a delay, counting them by method."""
+
+    def __init__(self, latency: float, retry_after_rate: float, retry_after: int, seed: int):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.retry_afters = Counter()
+        self.latencies = defaultdict(list)
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        self.latencies[api_method].append(time.perf_counter() - start)
+
+        if api_method == 'sendMessage' and self.random.random() < self.retry_after_rate:
+            self.retry_afters[api_method] += 1
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }).encode()
+
+        if api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif api_method == 'getChatMember':
+            user_id = int(params['user_id'])
+            result = {'status': 'member', 'user': member(user_id)}
+        elif api_method == 'getChat':
+            result = {'id': params['chat_id'], 'type': 'supergroup', 'title': f"Group {params['chat_id']}"}
+        elif api_method == 'sendMessage':
+            self._message_id += 1
+            result = {
+                'message_id': self._message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                'chat': {'id': params['chat_id'], 'type': 'supergroup'}
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+class IoCounter:
+    """Counts file opens under the data directory (via an audit hook) and SQL statements."""
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.counts = Counter()
+        self.enabled = False
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if not self.enabled:
+            return
+        if event == 'open' and isinstance(args[0], str) and args[0].startswith(self.data_dir):
+            path, mode, flags = args
+            # os.open (as used by tempfile) reports flags instead of a mode
+            writing = any(c in mode for c in 'wax+') if mode else flags & (os.O_WRONLY | os.O_RDWR)
+            self.counts['file_writes' if writing else 'file_reads'] += 1
+        elif event == 'os.rename':
+            self.counts['file_renames'] += 1
+
+    def count_sql(self, statement):
+        if self.enabled:
+            self.counts['sql_statements'] += 1
+
+def member(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Member{user_id}', 'username': f'member{user_id}'}
+
+def group_id_for(index: int) -> int:
+    return -1000000000000 - index
+
+def owner_for(group_id: int) -> int:
+    return -group_id
+
+class UpdateFactory:
+    """Builds raw update dicts for a fixed set of groups and members."""
+
+    def __init__(self, groups: int, members: int, test_lines: int, seed: int):
+        self.random = random.Random(seed)
+        self.group_ids = [group_id_for(i) for i in range(groups)]
+        self.members = {
+            group_id: [owner_for(group_id) * 1000 + i for i in range(1, members + 1)]
+            for group_id in self.group_ids
+        }
+        self.test_lines = test_lines
+        self._update_id = 0
+
+    def _message(self, group_id: int, user_id: int, text: str, reply_to: int = None, entities=None) -> dict:
+        self._update_id += 1
+        message = {
+            'message_id': self._update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': group_id, 'type': 'supergroup', 'title': f'Group {group_id}'},
+            'from': member(user_id)
+        }
+        if entities:
+            message['entities'] = entities
+        if reply_to is not None:
+            message['reply_to_message'] = {
+                'message_id': self._update_id - 1, 'date': int(time.time()), 'text': 'answer',
+                'chat': message['chat'], 'from': member(reply_to)
+            }
+        return {'update_id': self._update_id, 'message': message}
+
+    def _command(self, group_id: int, user_id: int, command: str) -> dict:
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return self._message(group_id, user_id, command, entities=entities)
+
+    def warmup(self) -> list:
+        """One message from every member, so names and usernames are known."""
+        return [
+            self._message(group_id, user_id, 'السلام عليكم')
+            for group_id in self.group_ids for user_id in self.members[group_id]
+        ]
+
+    def build(self, kind: str) -> dict:
+        group_id = self.random.choice(self.group_ids)
+        admin = owner_for(group_id)
+        student = self.random.choice(self.members[group_id])
+        if kind == 'award':
+            return self._message(group_id, admin, self.random.choice(abdol.KEYWORDS), reply_to=student)
+        if kind == 'subtract':
+            return self._message(group_id, admin, abdol.SUBTRACT_KEYWORDS[0], reply_to=student)
+        if kind == 'test':
+            students = self.random.sample(self.members[group_id], min(self.test_lines, len(self.members[group_id])))
+            lines = [f'@member{user_id} {self.random.randint(0, 100)}' for user_id in students]
+            return self._message(group_id, admin, '\n'.join(lines))
+        if kind == 'dash':
+            return self._command(group_id, student, '/dash')
+        if kind == 'rank':
+            return self._command(group_id, student, '/rank')
+        return self._message(group_id, student, 'تمام يا جماعة')
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        weights[kind.strip()] = float(weight)
+    unknown = set(weights) - {'award', 'subtract', 'test', 'dash', 'rank', 'chatter'}
+    if unknown:
+        raise SystemExit(f"unknown update kinds in --mix: {', '.join(sorted(unknown))}")
+    return weights
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def summarize(seconds: list) -> dict:
+    values = sorted(seconds)
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': (values[-1] if values else 0.0) * 1000
+    }
+
+async def run(args) -> dict:
+    api = StubBotApi(args.api_latency / 1000, args.retry_after_rate, args.retry_after, args.seed)
+    io = IoCounter(os.environ['DATA_DIR'])
+    if abdol.storage.name == 'sqlite':
+        abdol.storage.backend._conn.set_trace_callback(io.count_sql)
+
+    application = abdol.build_application(request=api, get_updates_request=StubBotApi(0, 0, 0, args.seed))
+    factory = UpdateFactory(args.groups, args.members, args.test_lines, args.seed)
+    weights = parse_mix(args.mix)
+    kinds = factory.random.choices(list(weights), list(weights.values()), k=args.updates)
+    updates = []
+
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        for group_id in factory.group_ids:
+            abdol.permission_cache.set_group(group_id, owner_for(group_id), [])
+
+        async def process(update: Update, kind: str, latencies: dict, semaphore: asyncio.Semaphore):
+            async with semaphore:
+                start = time.perf_counter()
+                await application.process_update(update)
+                latencies[kind].append(time.perf_counter() - start)
+
+        # Warm-up: every member speaks once; not measured
+        semaphore = asyncio.Semaphore(args.concurrency)
+        warmup = [Update.de_json(raw, application.bot) for raw in factory.warmup()]
+        await asyncio.gather(*(process(update, 'warmup', defaultdict(list), semaphore) for update in warmup))
+        await abdol.points_store.flush()
+        api.calls.clear()
+        api.latencies.clear()
+
+        # Decode up front so the timings only cover the handlers
+        updates = [(Update.de_json(factory.build(kind), application.bot), kind) for kind in kinds]
+        latencies = defaultdict(list)
+        io.enabled = True
+        started = time.perf_counter()
+        await asyncio.gather(*(process(update, kind, latencies, semaphore) for update, kind in updates))
+        elapsed = time.perf_counter() - started
+
+        # Let queued replies and write-behind flushes land before counting
+        await abdol.outbox.stop(timeout=args.drain_timeout)
+        abdol.outbox.start(application.bot)
+        await abdol.points_store.flush()
+        stream_calls = Counter(api.calls)
+        stream_io = Counter(io.counts)
+
+        leaderboard = []
+        context = CallbackContext(application)
+        sweep = asyncio.Semaphore(abdol.LEADERBOARD_SWEEP_CONCURRENCY)
+
+        async def send_one(group_id: int):
+            async with sweep:
+                start = time.perf_counter()
+                await abdol.send_leaderboard(context, group_id)
+                leaderboard.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(send_one(group_id) for group_id in factory.group_ids))
+        io.enabled = False
+
+        await application.stop()
+        await application.post_stop(application)
+
+    total = len(updates)
+    all_latencies = [seconds for values in latencies.values() for seconds in values]
+    return {
+        'config': {
+            'groups': args.groups, 'members': args.members, 'updates': args.updates, 'mix': weights,
+            'test_lines': args.test_lines, 'api_latency_ms': args.api_latency,
+            'retry_after_rate': args.retry_after_rate, 'concurrency': args.concurrency,
+            'backend': abdol.storage.name, 'real_limits': args.real_limits, 'seed': args.seed
+        },
+        'seconds': elapsed,
+        'updates_per_sec': total / elapsed if elapsed else 0.0,
+        'latency': {'all': summarize(all_latencies), **{kind: summarize(v) for kind, v in sorted(latencies.items())}},
+        'api_calls': dict(stream_calls),
+        'api_calls_per_update': sum(stream_calls.values()) / total if total else 0.0,
+        'api_latency': {method: summarize(v) for method, v in sorted(api.latencies.items())},
+        'retry_after': dict(api.retry_afters),
+        'io': dict(stream_io),
+        'io_per_update': {name: count / total for name, count in stream_io.items()} if total else {},
+        'leaderboard': summarize(leaderboard)
+    }
+
+def print_table(results: dict):
+    config = results['config']
+    print(f"{config['updates']} updates across {config['groups']} groups x {config['members']} members "
+          f"({config['backend']} storage, {config['api_latency_ms']} ms API latency)")
+    print(f"throughput: {results['updates_per_sec']:.0f} updates/s over {results['seconds']:.2f}s")
+    print(f"\n{'kind':>10} {'count':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for kind, stats in results['latency'].items():
+        print(f"{kind:>10} {stats['count']:>7} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['max_ms']:>9.2f}")
+    stats = results['leaderboard']
+    print(f"{'weekly':>10} {stats['count']:>7} {stats['p50_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['max_ms']:>9.2f}")
+    print(f"\nAPI calls per update: {results['api_calls_per_update']:.3f} {results['api_calls']}")
+    print(f"RetryAfter responses: {results['retry_after']}")
+    print("I/O per update: " + ", ".join(f"{name} {value:.3f}" for name, value in sorted(results['io_per_update'].items())))
+
+def main():
+    global abdol
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--members', type=int, default=50, help='members per group')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='relative weights of update kinds')
+    parser.add_argument('--test-lines', type=int, default=20, help='lines per test-score message')
+    parser.add_argument('--api-latency', type=float, default=20, help='stub Bot API latency in ms')
+    parser.add_argument('--retry-after-rate', type=float, default=0.005, help='share of sendMessage calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds the 429 asks to wait')
+    parser.add_argument('--concurrency', type=int, default=64, help='updates processed at once')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='seconds to wait for queued replies')
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--real-limits', action='store_true', help="keep Telegram's rate limits in place")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    # abdol reads its config on import, so set it up first
+    os.environ['DATA_DIR'] = os.path.realpath(tempfile.mkdtemp(prefix='bench_handlers_'))
+    os.environ['STORAGE_BACKEND'] = args.backend
+    os.environ.setdefault('PORT', '0')
+    if not args.real_limits:
+        for name in ('API_RATE_LIMIT', 'API_CHAT_RATE_LIMIT', 'OUTBOX_CHAT_RATE', 'OUTBOX_CHAT_BURST'):
+            os.environ[name] = '1000000'
+
+    # Keep the bot's own logging out of the results
+    with contextlib.redirect_stdout(sys.stderr):
+        import abdol as module
+        abdol = module
+        results = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print_table(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Microbenchmark for the test-score parser.
+
+Builds synthetic exam-result messages of growing size (usernames, text
+mentions, blank and malformed lines) and times parse_test_scores plus
+index_text_mentions on each. The per-line cost should stay flat as the
+message grows; the last column shows it relative to the smallest input.
+
+    python benchmarks/bench_parser.py [--sizes 100,1000,10000,100000] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# abdol creates its data directory on import, so point it somewhere disposable
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_parser_"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram import MessageEntity, User  # noqa: E402
+
+import abdol  # noqa: E402
+
+def build_message(lines: int):
+    """Return (text, entities) with a mix of line shapes, like a pasted result sheet."""
+    parts = []
+    entities = []
+    offset = 0
+    for i in range(lines):
+        kind = i % 10
+        if kind == 0:
+            line = f"Student {i} ✨ {i % 100}"
+            entities.append(MessageEntity('text_mention', offset, len('Student'), user=User(i, 'Student', False)))
+        elif kind == 1:
+            line = ""
+        elif kind == 2:
+            line = "-- section --"
+        else:
+            line = f"@student_{i} {i % 100}.5"
+        parts.append(line)
+        offset += len(line.encode('utf-16-le')) // 2 + 1
+    return "\n".join(parts), entities
+
+def time_parse(text: str, entities, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        abdol.parse_test_scores(text)
+        abdol.index_text_mentions(text, entities)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000,100000')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print machine-readable results')
+    args = parser.parse_args()
+
+    results = []
+    for size in (int(s) for s in args.sizes.split(',')):
+        text, entities = build_message(size)
+        seconds = time_parse(text, entities, args.repeat)
+        results.append({'lines': size, 'seconds': seconds, 'us_per_line': seconds / size * 1e6})
+
+    baseline = results[0]['us_per_line']
+    for result in results:
+        result['relative_cost_per_line'] = result['us_per_line'] / baseline
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'lines':>8} {'total ms':>10} {'us/line':>9} {'relative':>9}")
+    for result in results:
+        print(f"{result['lines']:>8} {result['seconds'] * 1000:>10.2f} "
+              f"{result['us_per_line']:>9.3f} {result['relative_cost_per_line']:>9.2f}")
+
+if __name__ == '__main__':
+    main()